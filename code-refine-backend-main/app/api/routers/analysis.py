@@ -1,9 +1,24 @@
-from fastapi import APIRouter, HTTPException, Depends
-from pydantic import BaseModel, HttpUrl
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, HttpUrl, ValidationError, field_validator
+from typing import List, Optional
+from app.api.schemas import AnalysisReport
+from app.core.settings import settings
+from app.services.archive_service import ArchiveError, ArchiveService, ArchiveTooLargeError
 from app.services.github_service import GitHubService
-from app.services.llm_service import LLMService
+from app.services.budget_controller import budget_controller
+from app.services.cancellation import AnalysisCancelledError, CancelToken, StageTimeoutError
+from app.services.llm_service import ContextOverflowError, LLMService, RateLimitError
+from app.services.python_analysis import PythonAnalysisService
+from app.services.report_repair import salvage_report
+from app.services.single_flight import FlightCapacityError, analysis_flights
 from app.services.static_analysis import StaticAnalysisService
+from app.services.workspace_manager import WorkspaceError, normalize_repo_url, validate_ref
+import asyncio
+import json
 import logging
+import orjson
 import os
 
 # Configure logging
@@ -16,65 +31,648 @@ class AnalysisRequest(BaseModel):
     repo_url: str
     model_id: str = "llama-3.3-70b-versatile"
 
-@router.post("/")
-async def analyze_code(request: AnalysisRequest):
+class DiffAnalysisRequest(BaseModel):
+    repo_url: str
+    base_ref: str
+    head_ref: str
+    model_id: str = "llama-3.3-70b-versatile"
+
+    @field_validator("base_ref", "head_ref")
+    @classmethod
+    def _check_ref(cls, value):
+        # Refs end up on git command lines; reject options (e.g. --output=...) and malformed names
+        return validate_ref(value)
+
+class BatchRepo(BaseModel):
+    repo_url: str
+    ref: Optional[str] = None
+
+    @field_validator("ref")
+    @classmethod
+    def _check_ref(cls, value):
+        return validate_ref(value) if value else value
+
+class BatchAnalysisRequest(BaseModel):
+    repos: List[BatchRepo] = Field(min_length=1)
+    model_id: str = "llama-3.3-70b-versatile"
+    # Optional per-request overrides of the configured stage concurrency
+    clone_concurrency: Optional[int] = Field(default=None, ge=1, le=32)
+    static_concurrency: Optional[int] = Field(default=None, ge=1, le=32)
+    llm_concurrency: Optional[int] = Field(default=None, ge=1, le=32)
+
+
+# Share of the context budget the static-analysis section may take at each packing level;
+# cheaper levels send fewer bandit issues. The API response still carries all of them
+STATIC_BUDGET_SHARES = {"full": 0.2, "skeleton": 0.2}
+STATIC_BUDGET_SHARE_DEFAULT = 0.1
+
+
+def _trim_static_results(static_results: dict, max_tokens: int, count_tokens) -> dict:
+    # Most severe bandit issues first, as many as fit in max_tokens
+    security = static_results.get("security", {})
+    severity_order = {"HIGH": 0, "MEDIUM": 1, "LOW": 2}
+    issues = sorted(security.get("issues", []), key=lambda issue: severity_order.get(issue.get("severity"), 3))
+    kept = []
+    used = count_tokens(json.dumps({**static_results, "security": {**security, "issues": []}}))
+    for issue in issues:
+        used += count_tokens(json.dumps(issue))
+        if used > max_tokens:
+            break
+        kept.append(issue)
+    return {**static_results, "security": {**security, "issues": kept}}
+
+
+def _static_for_level(static_results: dict, level: str, budget: int, count_tokens) -> tuple:
+    # (static results trimmed to the level's share of the budget, their token count)
+    share = STATIC_BUDGET_SHARES.get(level, STATIC_BUDGET_SHARE_DEFAULT)
+    trimmed = _trim_static_results(static_results, int(budget * share), count_tokens)
+    return trimmed, count_tokens(json.dumps(trimmed))
+
+
+def _build_first_context(github_service: GitHubService, model_id: str, static_results: dict, build_context) -> str:
+    """
+    Builds the context for the richest packing level at the model's current budget minus
+    the static-analysis section, i.e. exactly what _analyze_with_ladder would send first.
+    Pass it on as first_context; callers build it in their "static" stage and can reject
+    empty content before any LLM call.
+    """
+    level = GitHubService.PACKING_LEVELS[0]
+    budget = budget_controller.get_budget(model_id)
+    _, static_tokens = _static_for_level(static_results, level, budget, github_service._get_token_count)
+    return build_context(level, budget - static_tokens)
+
+
+def _analyze_with_ladder(github_service: GitHubService, model_id: str, static_results: dict,
+                         build_context, first_context: str = None, review_scope: str = None,
+                         cancel_token: CancelToken = None) -> tuple:
+    """
+    Runs the LLM call through the budget controller: if the provider rejects the request
+    size (413), it retries with the next cheaper packing level; rate limits (429) are
+    waited out instead.
+    build_context(level, budget) rebuilds the context for a level.
+    The static-analysis section is trimmed to a share of the budget and the context is
+    built from the rest, so both together are what the controller measures and learns from.
+    All attempts together run under the token's "llm" deadline.
+    Returns (raw report, context info with the packing level used).
+    """
+    cancel_token = cancel_token or CancelToken()
+    llm_service = LLMService()
+    count_tokens = github_service._get_token_count
+    static_cache = {}
+
+    def level_static(level: str, budget: int) -> tuple:
+        if (level, budget) not in static_cache:
+            static_cache[(level, budget)] = _static_for_level(static_results, level, budget, count_tokens)
+        return static_cache[(level, budget)]
+
+    def build(level: str, budget: int) -> str:
+        return build_context(level, budget - level_static(level, budget)[1])
+
+    def measure(context: str, level: str, budget: int) -> int:
+        return count_tokens(context) + level_static(level, budget)[1]
+
+    def analyze(context: str, level: str, budget: int) -> tuple:
+        report = llm_service.analyze_code(
+            context, level_static(level, budget)[0], model_id=model_id, review_scope=review_scope,
+            cancel_token=cancel_token
+        )
+        return report, llm_service.last_prompt_tokens
+
+    if first_context is not None:
+        # Built by _build_first_context; rebuild if the budget has been lowered since
+        budget = budget_controller.get_budget(model_id)
+        level = GitHubService.PACKING_LEVELS[0]
+        if measure(first_context, level, budget) > budget - budget_controller.PROMPT_RESERVE:
+            first_context = None
+
+    with cancel_token.stage("llm"):
+        return budget_controller.run_with_ladder(
+            model_id,
+            GitHubService.PACKING_LEVELS,
+            build,
+            analyze,
+            measure,
+            first_context=first_context,
+            wait=cancel_token.sleep,
+        )
+
+
+def _new_cancel_token() -> CancelToken:
+    return CancelToken(deadlines={
+        "clone": settings.clone_timeout_seconds,
+        "static": settings.static_timeout_seconds,
+        "llm": settings.llm_timeout_seconds,
+    })
+
+
+async def _run_cancellable(cancel_token: CancelToken, func, *args, request: Request = None):
+    """
+    Runs a blocking pipeline step in a worker thread. The token is cancelled when the
+    awaiting task is cancelled or, if a request is given, when its client disconnects,
+    so the step stops at its next checkpoint instead of running for nobody.
+    """
+    async def watch_client():
+        while not cancel_token.cancelled:
+            if await request.is_disconnected():
+                cancel_token.cancel("client disconnected")
+                return
+            await asyncio.sleep(settings.disconnect_poll_seconds)
+
+    watcher = asyncio.create_task(watch_client()) if request is not None else None
     try:
-        logger.info(f"Received analysis request for: {request.repo_url} using model: {request.model_id}")
-        
-        # 1. Clone and Prepare Code Context with SMART LIMITS
-        github_service = GitHubService()
-        
-        # --- SMART TOKEN LIMITING STRATEGY ---
-        # Groq Free Tier has strict TPM (Tokens Per Minute) limits.
-        # We must limit the context window passed to the LLM to ensure we don't hit 413 (Payload Too Large).
-        
-        if "llama-3.1-8b" in request.model_id:
-            # Very strict limit for the 8B model (approx 6k TPM limit)
-            max_context_tokens = 5000 
-        elif "qwen" in request.model_id:
-             # Strict limit for Qwen (approx 6k TPM limit on Groq)
-            max_context_tokens = 5000
-        elif "llama-3.3" in request.model_id:
-            # Llama 3.3 has a slightly higher limit (~12k TPM), but we play safe.
-            max_context_tokens = 10000 
+        return await run_in_threadpool(func, *args)
+    except asyncio.CancelledError:
+        cancel_token.cancel("request cancelled")
+        raise
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+
+def _cancelled_exception(e: AnalysisCancelledError) -> HTTPException:
+    if isinstance(e, StageTimeoutError):
+        return HTTPException(status_code=504, detail=str(e))
+    # The client is gone; 499 (client closed request) only shows up in the access log
+    logger.info(f"Analysis abandoned: {e.reason}")
+    return HTTPException(status_code=499, detail=str(e))
+
+
+def _overflow_exception(e: ContextOverflowError) -> HTTPException:
+    # Keep the provider's status so the Frontend can catch 429/413 codes correctly
+    return HTTPException(status_code=e.status_code, detail=f"Model rejected even the smallest context: {str(e)}")
+
+
+def _rate_limit_exception(e: RateLimitError) -> HTTPException:
+    retry_after = str(max(1, round(e.retry_after))) if e.retry_after is not None else "10"
+    return HTTPException(status_code=429, detail=f"Model rate limit reached: {str(e)}", headers={"Retry-After": retry_after})
+
+
+def _parse_report(raw_report: str) -> dict:
+    """
+    Parses and validates the LLM output once, so clients receive structured JSON.
+    Slightly malformed output is repaired section by section; output with nothing
+    salvageable is kept as the executive summary instead of failing the request.
+    """
+    try:
+        report = AnalysisReport.model_validate_json(raw_report)
+    except ValidationError:
+        salvaged = salvage_report(raw_report, AnalysisReport, LLMService.REPORT_SECTIONS)
+        if salvaged.sections:
+            logger.warning(f"LLM report did not match the report schema; kept {sorted(salvaged.sections)}")
+            report = AnalysisReport(**salvaged.sections)
         else:
-            # Default safe fallback
-            max_context_tokens = 5000
-            
-        logger.debug(f"Applied Smart Context Limit: {max_context_tokens} tokens for model: {request.model_id}")
+            logger.warning("LLM report is not valid JSON for the report schema; returning it as summary")
+            report = AnalysisReport(executive_summary=raw_report or "")
+    return report.model_dump()
+
+
+def _drop_path(payload, parts: list):
+    # Copy-on-write so shared result dicts are never mutated
+    if not isinstance(payload, dict) or parts[0] not in payload:
+        return payload
+    payload = dict(payload)
+    if len(parts) == 1:
+        payload.pop(parts[0])
+    else:
+        payload[parts[0]] = _drop_path(payload[parts[0]], parts[1:])
+    return payload
+
+
+def _copy_path(source: dict, target: dict, parts: list):
+    if not isinstance(source, dict) or parts[0] not in source:
+        return
+    if len(parts) == 1:
+        target[parts[0]] = source[parts[0]]
+    elif isinstance(source[parts[0]], dict):
+        _copy_path(source[parts[0]], target.setdefault(parts[0], {}), parts[1:])
 
-        # Pass the limit to the cloning service. 
+
+def _select_fields(payload: dict, fields: Optional[str]) -> dict:
+    """
+    Applies the `fields` selector: a comma-separated list of dotted paths.
+    Plain paths keep only those fields; paths prefixed with '-' drop them,
+    e.g. fields=-static_analysis.security.issues
+    """
+    if not fields:
+        return payload
+    paths = [path.strip() for path in fields.split(",") if path.strip()]
+    include = [path.split(".") for path in paths if not path.startswith("-")]
+    exclude = [path[1:].split(".") for path in paths if path.startswith("-") and len(path) > 1]
+
+    if include:
+        selected = {}
+        for parts in include:
+            _copy_path(payload, selected, parts)
+        payload = selected
+    for parts in exclude:
+        payload = _drop_path(payload, parts)
+    return payload
+
+
+def _respond(payload: dict, fields: Optional[str]) -> ORJSONResponse:
+    # Returning the response directly skips FastAPI's jsonable_encoder walk; orjson does the rest
+    return ORJSONResponse(_select_fields(payload, fields))
+
+
+@router.post("/")
+async def analyze_code(request: AnalysisRequest, http_request: Request, fields: Optional[str] = Query(default=None)):
+    """
+    Concurrent requests for the same repository commit, model and context budget
+    share a single pipeline run (see SingleFlight).
+    """
+    github_service = GitHubService()
+    cancel_token = _new_cancel_token()
+
+    # The budget controller starts from the per-model defaults and learns from 413/429s
+    max_context_tokens = budget_controller.get_budget(request.model_id)
+    logger.debug(f"Applied Smart Context Limit: {max_context_tokens} tokens for model: {request.model_id}")
+
+    def resolve_commit() -> str:
+        with cancel_token.stage("clone"):
+            return github_service.workspaces.resolve(request.repo_url, cancel_token=cancel_token)
+
+    def run_pipeline(commit: str) -> dict:
+        # Reserved up front so an abandoned job can still release a checkout in progress
+        job_dir = github_service.workspaces.reserve()
+        try:
+            return analyze_commit(commit, job_dir)
+        finally:
+            # 4. Cleanup (also on failure, so the workspace never leaks)
+            github_service.cleanup(job_dir)
+
+    def analyze_commit(commit: str, job_dir: str) -> dict:
+        # 1. Clone and Prepare Code Context with SMART LIMITS
+
+        # Pass the limit to the cloning service.
         # The service will prioritize critical files and truncate less important ones to fit this budget.
-        repo_path, code_content = github_service.clone_and_prepare(
-            request.repo_url, 
-            max_tokens=max_context_tokens
+        repo_path, python_analyses = github_service.clone_and_prepare(
+            request.repo_url,
+            ref=commit,
+            job_dir=job_dir,
+            cancel_token=cancel_token
         )
+        if not repo_path:
+            raise HTTPException(status_code=400, detail="Could not extract valid code content from repository.")
+
+        def build_context(level: str, budget: int) -> str:
+            return github_service.get_repository_content(
+                repo_path, max_tokens=budget, python_analyses=python_analyses, packing=level, commit=commit
+            )
+
+        # 2. Run Static Analysis (Radon/Bandit), then pack the code around it with SMART LIMITS:
+        # the service prioritizes critical files and truncates less important ones to fit the budget
+        static_service = StaticAnalysisService()
+        with cancel_token.stage("static"):
+            static_results = static_service.analyze_repository(
+                repo_path, python_analyses=python_analyses, cancel_token=cancel_token
+            )
+            code_content = _build_first_context(github_service, request.model_id, static_results, build_context)
 
         if not code_content:
             raise HTTPException(status_code=400, detail="Could not extract valid code content from repository.")
 
-        # 2. Run Static Analysis (Radon/Bandit)
-        static_service = StaticAnalysisService()
-        static_results = static_service.analyze_repository(repo_path)
-        
-        # 3. AI Analysis
-        llm_service = LLMService()
-        analysis_report = llm_service.analyze_code(
-            code_content, 
+        # 3. AI Analysis (falls back to cheaper packing levels on 413/429)
+        analysis_report, context_info = _analyze_with_ladder(
+            github_service,
+            request.model_id,
             static_results,
-            model_id=request.model_id
+            build_context,
+            first_context=code_content,
+            cancel_token=cancel_token
         )
-        
-        # 4. Cleanup
-        github_service.cleanup(repo_path)
-        
+
         return {
             "repo_name": request.repo_url.split("/")[-1],
-            "report": analysis_report,
-            "static_analysis": static_results
+            "report": _parse_report(analysis_report),
+            "static_analysis": static_results,
+            "context": context_info
         }
 
+    try:
+        logger.info(f"Received analysis request for: {request.repo_url} using model: {request.model_id}")
+        commit = await _run_cancellable(cancel_token, resolve_commit, request=http_request)
+
+        # Identical requests already in flight: wait for that result instead of starting again
+        flight_key = (normalize_repo_url(request.repo_url), commit, request.model_id, max_context_tokens)
+        payload = await analysis_flights.run(
+            flight_key,
+            lambda: _run_cancellable(cancel_token, run_pipeline, commit),
+            cancel_token,
+            request=http_request
+        )
+        return _respond(payload, fields)
+
+    except HTTPException:
+        raise
+    except FlightCapacityError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "10"})
+    except AnalysisCancelledError as e:
+        raise _cancelled_exception(e)
+    except ContextOverflowError as e:
+        raise _overflow_exception(e)
+    except RateLimitError as e:
+        raise _rate_limit_exception(e)
+    except WorkspaceError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Analysis error: {str(e)}")
         # Raise HTTP exception so Frontend can catch 429/413 codes correctly
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/diff")
+async def analyze_diff(request: DiffAnalysisRequest, http_request: Request, fields: Optional[str] = Query(default=None)):
+    """
+    Reviews only what changed between base_ref and head_ref (e.g. a pull request).
+    Static analysis and the LLM context are limited to the changed files and hunks,
+    so latency scales with the diff instead of the repository.
+    """
+    github_service = GitHubService()
+    cancel_token = _new_cancel_token()
+    job_dir = github_service.workspaces.reserve()
+
+    def run_pipeline() -> dict:
+        # 1. Check out head and compute the changed line ranges
+        with cancel_token.stage("clone"):
+            repo_path = github_service.clone_repository(
+                request.repo_url, ref=request.head_ref, job_dir=job_dir, cancel_token=cancel_token
+            )
+            changed_lines = github_service.get_changed_lines(
+                repo_path, request.base_ref, request.head_ref, cancel_token=cancel_token
+            )
+        if not changed_lines:
+            raise HTTPException(status_code=400, detail="No changed files between the given refs.")
+
+        def build_context(level: str, budget: int) -> str:
+            return github_service.get_diff_content(repo_path, changed_lines, max_tokens=budget, packing=level)
+
+        # 2. Run Static Analysis on the changed files only, then pack the hunks around it
+        with cancel_token.stage("static"):
+            python_analyses = PythonAnalysisService().analyze_files([
+                os.path.join(repo_path, rel_path) for rel_path in changed_lines
+                if rel_path.endswith(".py") and os.path.isfile(os.path.join(repo_path, rel_path))
+            ], cancel_token=cancel_token)
+            static_results = StaticAnalysisService().analyze_changes(
+                repo_path, changed_lines, python_analyses=python_analyses, cancel_token=cancel_token
+            )
+            code_content = _build_first_context(github_service, request.model_id, static_results, build_context)
+        if not code_content:
+            raise HTTPException(status_code=400, detail="Could not extract valid code content from the diff.")
+
+        # 3. AI Analysis scoped to the diff
+        review_scope = (
+            f"Pull request review of {request.base_ref}...{request.head_ref}. "
+            "Lines prefixed with '+' are changed; other lines and SKELETON files are unchanged context. "
+            "Only report findings that concern the changed lines."
+        )
+        analysis_report, context_info = _analyze_with_ladder(
+            github_service,
+            request.model_id,
+            static_results,
+            build_context,
+            first_context=code_content,
+            review_scope=review_scope,
+            cancel_token=cancel_token
+        )
+
+        return {
+            "repo_name": request.repo_url.rstrip("/").split("/")[-1],
+            "base_ref": request.base_ref,
+            "head_ref": request.head_ref,
+            "changed_files": sorted(changed_lines),
+            "report": _parse_report(analysis_report),
+            "static_analysis": static_results,
+            "context": context_info
+        }
+
+    try:
+        logger.info(
+            f"Received diff analysis request for: {request.repo_url} "
+            f"({request.base_ref}...{request.head_ref}) using model: {request.model_id}"
+        )
+        return _respond(await _run_cancellable(cancel_token, run_pipeline, request=http_request), fields)
+
+    except HTTPException:
+        raise
+    except AnalysisCancelledError as e:
+        raise _cancelled_exception(e)
+    except ContextOverflowError as e:
+        raise _overflow_exception(e)
+    except RateLimitError as e:
+        raise _rate_limit_exception(e)
+    except WorkspaceError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Diff analysis error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        github_service.cleanup(job_dir)
+
+
+@router.post("/upload")
+async def analyze_upload(
+    request: Request,
+    model_id: str = Query(default="llama-3.3-70b-versatile"),
+    name: str = Query(default="upload", max_length=200),
+    fields: Optional[str] = Query(default=None),
+):
+    """
+    Analyzes a working tree uploaded as the raw request body (tar, tar.gz or zip),
+    e.g. `curl --data-binary @src.tar.gz`. Skips the remote clone entirely.
+    The body is streamed to disk and extracted with size and entry-count limits.
+    """
+    max_upload_bytes = settings.upload_max_mb * 1024 * 1024
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_upload_bytes:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {settings.upload_max_mb} MB.")
+
+    github_service = GitHubService()
+    archive_service = ArchiveService(
+        max_upload_bytes=max_upload_bytes,
+        max_extracted_bytes=settings.upload_max_extracted_mb * 1024 * 1024,
+        max_entries=settings.upload_max_entries,
+    )
+    cancel_token = _new_cancel_token()
+    job_dir = github_service.workspaces.allocate()
+    archive_path = os.path.join(job_dir, "upload.archive")
+
+    def run_pipeline() -> dict:
+        # 2. Unpack into the job workspace (takes the place of the clone stage)
+        with cancel_token.stage("clone"):
+            repo_path = archive_service.extract(archive_path, os.path.join(job_dir, "tree"))
+            os.remove(archive_path)
+
+        def build_context(level: str, budget: int) -> str:
+            return github_service.get_repository_content(
+                repo_path, max_tokens=budget, python_analyses=python_analyses, packing=level
+            )
+
+        # 3. Same pipeline as a cloned repository
+        with cancel_token.stage("static"):
+            python_analyses = PythonAnalysisService().analyze_repository(repo_path, cancel_token=cancel_token)
+            static_results = StaticAnalysisService().analyze_repository(
+                repo_path, python_analyses=python_analyses, cancel_token=cancel_token
+            )
+            code_content = _build_first_context(github_service, model_id, static_results, build_context)
+            if not code_content:
+                raise HTTPException(status_code=400, detail="Could not extract valid code content from upload.")
+
+        analysis_report, context_info = _analyze_with_ladder(
+            github_service,
+            model_id,
+            static_results,
+            build_context,
+            first_context=code_content,
+            cancel_token=cancel_token
+        )
+
+        return {
+            "repo_name": name,
+            "report": _parse_report(analysis_report),
+            "static_analysis": static_results,
+            "context": context_info
+        }
+
+    try:
+        logger.info(f"Received upload analysis request for: {name} using model: {model_id}")
+
+        # 1. Stream the archive to disk
+        await archive_service.save_stream(request.stream(), archive_path)
+        return _respond(await _run_cancellable(cancel_token, run_pipeline, request=request), fields)
+
+    except HTTPException:
+        raise
+    except AnalysisCancelledError as e:
+        raise _cancelled_exception(e)
+    except ContextOverflowError as e:
+        raise _overflow_exception(e)
+    except RateLimitError as e:
+        raise _rate_limit_exception(e)
+    except ArchiveTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ArchiveError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Upload analysis error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        github_service.cleanup(job_dir)
+
+
+@router.post("/batch")
+async def analyze_batch(request: BatchAnalysisRequest, fields: Optional[str] = Query(default=None)):
+    """
+    Analyzes many repositories in one call.
+    Duplicate (repo_url, ref) pairs are analyzed once. Each pipeline stage
+    (clone, static analysis, LLM) has its own concurrency limit, and results
+    are streamed back as NDJSON lines in completion order.
+    """
+    # 1. De-duplicate while keeping the caller's order
+    unique_repos = {}
+    for repo in request.repos:
+        key = (normalize_repo_url(repo.repo_url), repo.ref or None)
+        unique_repos.setdefault(key, repo)
+
+    if len(unique_repos) > settings.batch_max_repos:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many repositories in batch (max {settings.batch_max_repos})."
+        )
+
+    logger.info(
+        f"Received batch analysis request for {len(unique_repos)} repositories "
+        f"({len(request.repos) - len(unique_repos)} duplicates dropped) using model: {request.model_id}"
+    )
+
+    # 2. One semaphore per stage so slow LLM calls don't block cloning and vice versa
+    clone_limit = asyncio.Semaphore(request.clone_concurrency or settings.batch_clone_concurrency)
+    static_limit = asyncio.Semaphore(request.static_concurrency or settings.batch_static_concurrency)
+    llm_limit = asyncio.Semaphore(request.llm_concurrency or settings.batch_llm_concurrency)
+
+    async def analyze_one(repo: BatchRepo) -> dict:
+        github_service = GitHubService()
+        # Deadlines apply per repository; closing the stream cancels every token
+        cancel_token = _new_cancel_token()
+        # Reserved up front so a cancelled task can still release a checkout in progress
+        job_dir = github_service.workspaces.reserve()
+
+        def checkout() -> str:
+            with cancel_token.stage("clone"):
+                return github_service.clone_repository(
+                    repo.repo_url, ref=repo.ref, job_dir=job_dir, cancel_token=cancel_token
+                )
+
+        def analyze_checkout(repo_path: str) -> tuple:
+            # The parse/complexity/security pass and the packing are the CPU-bound part,
+            # so they run under static_limit
+            commit = github_service.workspaces.commit_of(repo_path)
+            with cancel_token.stage("static"):
+                python_analyses = PythonAnalysisService().analyze_repository(repo_path, cancel_token=cancel_token)
+                static_results = StaticAnalysisService().analyze_repository(
+                    repo_path, python_analyses=python_analyses, cancel_token=cancel_token
+                )
+
+                def build_context(level: str, budget: int) -> str:
+                    return github_service.get_repository_content(
+                        repo_path, max_tokens=budget, python_analyses=python_analyses, packing=level, commit=commit
+                    )
+
+                code_content = _build_first_context(github_service, request.model_id, static_results, build_context)
+                if not code_content:
+                    raise ValueError("Could not extract valid code content from repository.")
+            return build_context, code_content, static_results
+
+        try:
+            async with clone_limit:
+                repo_path = await _run_cancellable(cancel_token, checkout)
+
+            async with static_limit:
+                build_context, code_content, static_results = await _run_cancellable(
+                    cancel_token, analyze_checkout, repo_path
+                )
+
+            async with llm_limit:
+                analysis_report, context_info = await _run_cancellable(
+                    cancel_token,
+                    _analyze_with_ladder,
+                    github_service,
+                    request.model_id,
+                    static_results,
+                    build_context,
+                    code_content,
+                    None,
+                    cancel_token,
+                )
+
+            return {
+                "repo_url": repo.repo_url,
+                "ref": repo.ref,
+                "status": "ok",
+                "repo_name": repo.repo_url.rstrip("/").split("/")[-1],
+                "report": _parse_report(analysis_report),
+                "static_analysis": static_results,
+                "context": context_info,
+            }
+        except Exception as e:
+            logger.error(f"Batch analysis error for {repo.repo_url}: {str(e)}")
+            return {
+                "repo_url": repo.repo_url,
+                "ref": repo.ref,
+                "status": "error",
+                "detail": str(e),
+            }
+        finally:
+            github_service.cleanup(job_dir)
+
+    async def stream_results():
+        tasks = [asyncio.create_task(analyze_one(repo)) for repo in unique_repos.values()]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                yield orjson.dumps(_select_fields(result, fields)) + b"\n"
+        finally:
+            # Client went away (or we are done): stop anything still queued
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
@@ -0,0 +1,21 @@
+from fastapi import APIRouter
+from fastapi.responses import ORJSONResponse
+
+from app.services.warmup import warmup
+
+router = APIRouter()
+
+
+@router.get("/live")
+async def live():
+    return {"status": "ok"}
+
+
+@router.get("/ready")
+async def ready():
+    """
+    503 until the background warm-up has finished, then 200.
+    Point the orchestrator's readiness probe here and the liveness probe at /health/live.
+    """
+    status = warmup.status()
+    return ORJSONResponse(status, status_code=200 if warmup.ready else 503)
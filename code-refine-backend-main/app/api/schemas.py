@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr, Field, ConfigDict
+from pydantic import BaseModel, EmailStr, Field, ConfigDict, field_validator
 from typing import Literal
 
 class UserCreate(BaseModel):
@@ -22,4 +22,49 @@ class UserRead(BaseModel):
 
 class Token(BaseModel):
     access_token: str
-    token_type: str = "bearer"
\ No newline at end of file
+    token_type: str = "bearer"
+
+class CodeSmell(BaseModel):
+    file: str = ""
+    severity: str = ""
+    description: str = ""
+    suggestion: str = ""
+
+
+class TechnicalDebtItem(BaseModel):
+    category: str = ""
+    impact: str = ""
+    description: str = ""
+
+
+class RefactoringSuggestion(BaseModel):
+    title: str = ""
+    description: str = ""
+    code_before: str = ""
+    code_after: str = ""
+
+
+class AnalysisReport(BaseModel):
+    """
+    The LLM report, parsed and validated once on the server so clients get
+    structured JSON instead of a string they have to parse again.
+    """
+    executive_summary: str = ""
+    key_strengths: list[str] = []
+    critical_issues: list[str] = []
+    quality_score: int = 0
+    code_smells: list[CodeSmell] = []
+    technical_debt: list[TechnicalDebtItem] = []
+    refactoring_suggestions: list[RefactoringSuggestion] = []
+    security_analysis: str = ""
+    # Sections the model never delivered (output cut off, continuation failed); the rest is usable
+    incomplete_sections: list[str] = []
+
+    @field_validator("quality_score", mode="before")
+    @classmethod
+    def _clamp_score(cls, value):
+        # Models sometimes answer "75", 72.5 or 110; keep the number, not the failure
+        try:
+            return min(100, max(0, round(float(value))))
+        except (TypeError, ValueError):
+            return 0
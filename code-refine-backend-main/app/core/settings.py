@@ -7,7 +7,39 @@ class Settings(BaseSettings):
     database_url: str
     
     # Groq API anahtarını .env dosyasından okumak için bu satırı ekledik
-    groq_api_key: str 
+    groq_api_key: str
+
+    # Batch analysis: how many repos may be in each pipeline stage at once
+    batch_max_repos: int = 200
+    batch_clone_concurrency: int = 4
+    batch_static_concurrency: int = 2
+    batch_llm_concurrency: int = 2
+
+    # Per-job checkouts: shared mirrors + worktrees under workspace_root (defaults to the system temp dir)
+    workspace_root: str | None = None
+    workspace_quota_mb: int = 5120
+    workspace_fetch_interval_seconds: int = 30
+
+    # Archive uploads (/analysis/upload)
+    upload_max_mb: int = 100
+    upload_max_extracted_mb: int = 500
+    upload_max_entries: int = 20000
+
+    # Worker processes for the shared Python analysis pass (defaults to the usable CPUs, at most 4)
+    analysis_workers: int | None = None
+
+    # Per-stage deadlines (seconds) for one analysis job, and how often to check for a gone client
+    clone_timeout_seconds: int = 300
+    static_timeout_seconds: int = 300
+    llm_timeout_seconds: int = 240
+    disconnect_poll_seconds: float = 1.0
+
+    # Identical concurrent /analysis/ requests share one pipeline; at most this many wait on a leader
+    coalesce_max_followers: int = 50
+
+    # Startup: tiktoken BPE cache (the Docker image bakes one in) and background warm-up
+    tiktoken_cache_dir: str | None = None
+    warmup_on_startup: bool = True
 
     model_config = SettingsConfigDict(env_file=".env", case_sensitive=False)
 
@@ -1,10 +1,42 @@
+import time
+_import_started = time.perf_counter()
+
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from brotli_asgi import BrotliMiddleware
 
 # 'analysis' router'ını buraya import ediyoruz
-from app.api.routers import auth, users, analysis
+# (heavy dependencies such as groq, git and tiktoken are imported on first use, see WarmupService)
+from app.api.routers import auth, users, analysis, health
+from app.core.settings import settings
+from app.services.warmup import warmup
+from app.services.workspace_manager import workspace_manager
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Job directories of crashed or restarted processes; live workers sharing the root keep theirs
+    await asyncio.to_thread(workspace_manager.sweep_stale_jobs)
+    # Warm up in the background so the server starts accepting connections right away
+    if settings.warmup_on_startup:
+        warmup.start()
+    else:
+        warmup.mark_ready()
+    yield
+
 
-app = FastAPI(title="CodeRefine API")
+app = FastAPI(title="CodeRefine API", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Brotli for clients that accept it, gzip otherwise; reports for big repos reach megabytes.
+# The NDJSON batch stream is left alone: the compressors buffer across chunks, so per-repo
+# results would only arrive when the whole batch is done
+app.add_middleware(
+    BrotliMiddleware, minimum_size=1000, gzip_fallback=True, excluded_handlers=[r"^/analysis/batch/?$"]
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,3 +52,8 @@ app.include_router(users.router, prefix="/users", tags=["users"])
 # YENİ EKLENEN SATIR: Analiz router'ını uygulamaya dahil et
 # Bu, /analysis/ adresini aktif hale getirecek
 app.include_router(analysis.router, prefix="/analysis", tags=["analysis"])
+
+# Liveness and readiness probes
+app.include_router(health.router, prefix="/health", tags=["health"])
+
+warmup.record("app_import", time.perf_counter() - _import_started)
@@ -0,0 +1,142 @@
+import logging
+import os
+import re
+import tarfile
+import zipfile
+from typing import AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class ArchiveTooLargeError(ArchiveError):
+    pass
+
+
+class ArchiveService:
+    """
+    Receives an uploaded working tree (tar, tar.gz or zip) and unpacks it safely:
+    the upload is streamed to disk chunk by chunk, and extraction rejects path
+    traversal, skips links and device files, and enforces size and entry-count limits.
+    Git metadata (any `.git` path component) is never extracted: a planted config
+    (hooks, core.fsmonitor) would run commands as soon as anything invoked git in the tree.
+    """
+
+    def __init__(self, max_upload_bytes: int, max_extracted_bytes: int, max_entries: int):
+        self.max_upload_bytes = max_upload_bytes
+        self.max_extracted_bytes = max_extracted_bytes
+        self.max_entries = max_entries
+
+    async def save_stream(self, chunks: AsyncIterator[bytes], target_file: str) -> int:
+        """
+        Writes the incoming byte chunks to target_file without holding the whole upload in memory.
+        Returns the number of bytes written.
+        """
+        written = 0
+        with open(target_file, 'wb') as f:
+            async for chunk in chunks:
+                written += len(chunk)
+                if written > self.max_upload_bytes:
+                    raise ArchiveTooLargeError(f"Upload exceeds {self.max_upload_bytes} bytes.")
+                f.write(chunk)
+        if written == 0:
+            raise ArchiveError("Upload is empty.")
+        return written
+
+    def extract(self, archive_path: str, target_dir: str) -> str:
+        """
+        Extracts the archive into target_dir and returns the root of the source tree
+        (a single top-level directory, as produced by `git archive --prefix`, is unwrapped).
+        """
+        os.makedirs(target_dir, exist_ok=True)
+        if zipfile.is_zipfile(archive_path):
+            self._extract_zip(archive_path, target_dir)
+        else:
+            try:
+                self._extract_tar(archive_path, target_dir)
+            except tarfile.TarError as e:
+                raise ArchiveError(f"Unsupported or corrupt archive: {str(e)}")
+
+        entries = os.listdir(target_dir)
+        if len(entries) == 1 and os.path.isdir(os.path.join(target_dir, entries[0])):
+            return os.path.join(target_dir, entries[0])
+        return target_dir
+
+    def _extract_tar(self, archive_path: str, target_dir: str):
+        extracted = 0
+        # "r|*" reads the archive sequentially (any compression) without seeking back
+        with tarfile.open(archive_path, mode='r|*') as archive:
+            for count, member in enumerate(archive, start=1):
+                if count > self.max_entries:
+                    raise ArchiveTooLargeError(f"Archive has more than {self.max_entries} entries.")
+                destination = self._safe_destination(target_dir, member.name)
+                if self._is_git_path(member.name):
+                    continue
+                if member.isdir():
+                    os.makedirs(destination, exist_ok=True)
+                    continue
+                if not member.isfile():
+                    continue  # Symlinks, hard links and devices are never extracted
+
+                extracted += member.size
+                if extracted > self.max_extracted_bytes:
+                    raise ArchiveTooLargeError(f"Archive expands beyond {self.max_extracted_bytes} bytes.")
+                source = archive.extractfile(member)
+                self._write_file(source, destination, member.size)
+        logger.info(f"Extracted {extracted} bytes from tar archive")
+
+    def _extract_zip(self, archive_path: str, target_dir: str):
+        extracted = 0
+        try:
+            with zipfile.ZipFile(archive_path) as archive:
+                members = archive.infolist()
+                if len(members) > self.max_entries:
+                    raise ArchiveTooLargeError(f"Archive has more than {self.max_entries} entries.")
+                for member in members:
+                    destination = self._safe_destination(target_dir, member.filename)
+                    if self._is_git_path(member.filename):
+                        continue
+                    if member.is_dir():
+                        os.makedirs(destination, exist_ok=True)
+                        continue
+                    # Unix symlinks are stored as regular entries with S_IFLNK in the external attributes
+                    if (member.external_attr >> 16) & 0o170000 == 0o120000:
+                        continue
+
+                    extracted += member.file_size
+                    if extracted > self.max_extracted_bytes:
+                        raise ArchiveTooLargeError(f"Archive expands beyond {self.max_extracted_bytes} bytes.")
+                    with archive.open(member) as source:
+                        self._write_file(source, destination, member.file_size)
+            logger.info(f"Extracted {extracted} bytes from zip archive")
+        except zipfile.BadZipFile as e:
+            raise ArchiveError(f"Corrupt zip archive: {str(e)}")
+
+    @staticmethod
+    def _is_git_path(name: str) -> bool:
+        # Zip entries may use backslashes; case-insensitive file systems treat .GIT as .git
+        return any(part.lower() == ".git" for part in re.split(r"[\\/]", name))
+
+    def _safe_destination(self, target_dir: str, name: str) -> str:
+        root = os.path.realpath(target_dir)
+        destination = os.path.realpath(os.path.join(root, name))
+        if os.path.isabs(name) or os.path.commonpath([root, destination]) != root:
+            raise ArchiveError(f"Archive entry escapes the target directory: {name}")
+        return destination
+
+    def _write_file(self, source, destination: str, declared_size: int):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        written = 0
+        with open(destination, 'wb') as target:
+            while True:
+                chunk = source.read(64 * 1024)
+                if not chunk:
+                    break
+                written += len(chunk)
+                # Don't trust the header: a forged size must not bypass the extraction limit
+                if written > declared_size:
+                    raise ArchiveError(f"Archive entry is larger than declared: {destination}")
+                target.write(chunk)
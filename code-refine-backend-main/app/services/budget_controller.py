@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.services.llm_service import ContextOverflowError, RateLimitError
+
+logger = logging.getLogger(__name__)
+
+
+class BudgetController:
+    """
+    Learns how many context tokens each model accepts and degrades gracefully when
+    the provider rejects a request.
+
+    Budgets start from the static per-model table. A 413 (or a 429 for a request
+    larger than the limit itself) shrinks the model's budget below what was just
+    sent (multiplicative decrease); successful calls that used most of the budget,
+    as reported by the provider, let it grow again slowly (additive increase).
+    Within one request, an overflow retries with the next, cheaper packing level
+    instead of failing. A plain rate-limit 429 says nothing about size: the same
+    level is retried after retry-after and the budget is left alone.
+    """
+
+    # Groq Free Tier has strict TPM (Tokens Per Minute) limits, so start conservative.
+    # Matched by substring of the model id, first match wins.
+    DEFAULT_BUDGETS = [
+        ("llama-3.1-8b", 5000),  # approx 6k TPM limit
+        ("qwen", 5000),          # approx 6k TPM limit on Groq
+        ("llama-3.3", 10000),    # ~12k TPM, but we play safe
+    ]
+    FALLBACK_BUDGET = 5000
+
+    MIN_BUDGET = 1500
+    # Part of every budget that context builders keep free for the prompt itself
+    PROMPT_RESERVE = 1000
+    DECREASE_FACTOR = 0.8
+    INCREASE_STEP = 0.05
+    # Never grow past this multiple of the default
+    MAX_GROWTH = 2.0
+    # Rate limits: waits beyond this are handed back to the client as a 429
+    RATE_LIMIT_RETRIES = 2
+    MAX_RATE_LIMIT_WAIT = 30.0
+    DEFAULT_RATE_LIMIT_WAIT = 5.0
+
+    def __init__(self):
+        self._budgets = {}  # model id -> learned budget
+        self._lock = threading.Lock()
+
+    def _default_budget(self, model_id: str) -> int:
+        for pattern, budget in self.DEFAULT_BUDGETS:
+            if pattern in model_id:
+                return budget
+        return self.FALLBACK_BUDGET
+
+    def get_budget(self, model_id: str) -> int:
+        with self._lock:
+            return self._budgets.get(model_id, self._default_budget(model_id))
+
+    def record_success(self, model_id: str, tokens_sent: int):
+        """
+        The provider accepted a request whose context had tokens_sent tokens.
+        """
+        with self._lock:
+            current = self._budgets.get(model_id, self._default_budget(model_id))
+            ceiling = int(self._default_budget(model_id) * self.MAX_GROWTH)
+            # Only probe upwards when the context actually filled most of the budget
+            if tokens_sent >= (current - self.PROMPT_RESERVE) * 0.8 and current < ceiling:
+                self._budgets[model_id] = min(ceiling, int(current * (1 + self.INCREASE_STEP)))
+
+    def record_overflow(self, model_id: str, tokens_sent: int):
+        """
+        The provider rejected a request whose context had tokens_sent tokens.
+        """
+        with self._lock:
+            current = self._budgets.get(model_id, self._default_budget(model_id))
+            learned = max(self.MIN_BUDGET, int(min(current, tokens_sent) * self.DECREASE_FACTOR))
+            self._budgets[model_id] = learned
+        logger.warning(f"Context budget for {model_id} lowered to {learned} tokens")
+
+    def run_with_ladder(
+        self,
+        model_id: str,
+        levels: List[str],
+        build_context: Callable[[str, int], str],
+        analyze: Callable[[str, str, int], Tuple[str, Optional[int]]],
+        count_tokens: Callable[[str, str, int], int],
+        first_context: Optional[str] = None,
+        wait: Callable[[float], None] = time.sleep,
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        Calls analyze(context, level, budget) with progressively cheaper packing levels until
+        the provider accepts the request.
+        build_context(level, budget) builds the context; first_context, if given, is
+        the already built context for levels[0] at the current budget.
+        count_tokens(context, level, budget) estimates the request size; analyze returns
+        (report, prompt tokens reported by the provider or None).
+        Rate limits are waited out with wait(seconds) (at most RATE_LIMIT_RETRIES times).
+        Returns (report, info) where info says which level and budget were used.
+        Raises the last ContextOverflowError if even the cheapest level is rejected,
+        or the RateLimitError if the wait would be too long.
+        """
+        last_error = None
+        attempt = 0
+        rate_limit_retries = 0
+        index = 0
+        while index < len(levels):
+            level = levels[index]
+            attempt += 1
+            budget = self.get_budget(model_id)
+            if index == 0 and first_context is not None:
+                context = first_context
+            else:
+                context = build_context(level, budget)
+            tokens_sent = count_tokens(context, level, budget)
+
+            try:
+                report, reported_tokens = analyze(context, level, budget)
+            except RateLimitError as e:
+                wait_seconds = e.retry_after if e.retry_after is not None else self.DEFAULT_RATE_LIMIT_WAIT
+                if rate_limit_retries >= self.RATE_LIMIT_RETRIES or wait_seconds > self.MAX_RATE_LIMIT_WAIT:
+                    raise
+                rate_limit_retries += 1
+                logger.warning(f"Rate limited on {model_id}; retrying {level} in {wait_seconds:.1f}s")
+                wait(wait_seconds)
+                continue
+            except ContextOverflowError as e:
+                logger.warning(f"Attempt {attempt} ({level}, {budget} tokens) rejected for {model_id}: {e.status_code}")
+                self.record_overflow(model_id, tokens_sent)
+                last_error = e
+                index += 1
+                continue
+
+            # The provider's count covers the whole prompt; our estimate is the fallback
+            self.record_success(model_id, reported_tokens or tokens_sent)
+            return report, {"packing_level": level, "budget_tokens": budget, "attempts": attempt}
+
+        raise last_error
+
+
+budget_controller = BudgetController()
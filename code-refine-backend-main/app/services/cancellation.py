@@ -0,0 +1,175 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisCancelledError(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class StageTimeoutError(AnalysisCancelledError):
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"{stage} stage exceeded its {timeout:g}s deadline")
+        self.stage = stage
+
+
+class CancelToken:
+    """
+    Shared by every stage of one analysis job so the job can be stopped from outside
+    (client disconnect) or by a per-stage deadline.
+
+    Cancelling kills the child processes started through the token and runs the
+    registered callbacks; blocking code checks raise_if_cancelled() between units
+    of work, so the job unwinds through its normal cleanup path.
+    """
+
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, deadlines: Optional[Dict[str, float]] = None):
+        self.deadlines = deadlines or {}  # stage name -> seconds
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._processes = set()
+        self._callbacks = []
+        self._error = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled", error: AnalysisCancelledError = None):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._error = error or AnalysisCancelledError(reason)
+            self._event.set()
+            processes = list(self._processes)
+            callbacks = list(self._callbacks)
+        logger.warning(f"Cancelling analysis job: {self._error.reason}")
+
+        for process in processes:
+            self._kill(process)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug(f"Cancel callback failed: {e}")
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise self._error
+
+    def sleep(self, seconds: float):
+        """
+        Sleeps for up to seconds; raises as soon as the token is cancelled.
+        """
+        if self._event.wait(seconds):
+            raise self._error
+
+    def add_callback(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Registers a callback to run on cancellation and returns a function that unregisters it.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove_callback(callback)
+        callback()
+        return lambda: None
+
+    def _remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    # --- Cancellable work ---
+
+    def run_process(self, args: list, **kwargs) -> subprocess.CompletedProcess:
+        """
+        Like subprocess.run(capture_output=True), but the process (and its children,
+        e.g. git's transport helpers) is killed as soon as the token is cancelled.
+        """
+        self.raise_if_cancelled()
+        process = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=(os.name == "posix"), **kwargs
+        )
+        with self._lock:
+            self._processes.add(process)
+            cancelled = self._event.is_set()
+        try:
+            if cancelled:
+                # cancel() ran before the process was registered
+                self._kill(process)
+            stdout, stderr = process.communicate()
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+        self.raise_if_cancelled()
+        return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Runs a blocking call that can't be interrupted (e.g. an HTTP request) in a helper
+        thread and stops waiting for it as soon as the token is cancelled.
+        An abandoned call finishes in the background and its result is discarded.
+        """
+        self.raise_if_cancelled()
+        future = Future()
+
+        def target():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=target, daemon=True).start()
+        while True:
+            try:
+                return future.result(timeout=self.POLL_INTERVAL)
+            except FutureTimeoutError:
+                self.raise_if_cancelled()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Runs a block under the deadline configured for `name`, if any.
+        When the deadline passes, the whole job is cancelled with a StageTimeoutError.
+        """
+        self.raise_if_cancelled()
+        timeout = self.deadlines.get(name)
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, self.cancel, kwargs={"error": StageTimeoutError(name, timeout)})
+            timer.daemon = True
+            timer.start()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            if timer is not None:
+                timer.cancel()
+            logger.info(f"Stage {name} finished in {time.monotonic() - started:.2f}s")
+        self.raise_if_cancelled()
+
+    @staticmethod
+    def _kill(process: subprocess.Popen):
+        try:
+            if os.name == "posix":
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except (ProcessLookupError, PermissionError, OSError):
+            pass
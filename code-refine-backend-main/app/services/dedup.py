@@ -0,0 +1,124 @@
+import hashlib
+import re
+from collections import Counter, defaultdict
+from typing import List, Optional, Tuple
+
+
+class Fingerprint:
+    __slots__ = ("digest", "signature")
+
+    def __init__(self, digest: bytes, signature: Optional[Tuple[int, ...]]):
+        self.digest = digest
+        self.signature = signature  # None when the text is too short to compare reliably
+
+
+class DuplicateIndex:
+    """
+    Recognizes files whose content is already in the LLM context: exact copies by a
+    hash of the whitespace-normalized text, near-duplicates (vendored copies with local
+    edits, regenerated clients) by MinHash over token shingles.
+
+    Signatures use one-permutation hashing (one hash per shingle, split into bins), and
+    lookups go through LSH band buckets, so fingerprinting is linear in the file size
+    and a lookup does not grow with the number of indexed files.
+    """
+
+    SHINGLE_SIZE = 5
+    NUM_BINS = 64
+    BANDS = 16
+    # A candidate must share this many bands before its signature is compared. At the threshold
+    # a true near-duplicate shares ~8 of 16 on average; files that merely share boilerplate
+    # (generated clients) rarely reach 3, which keeps lookups cheap when buckets get crowded
+    MIN_BAND_MATCHES = 3
+    # Estimated Jaccard similarity at which a file counts as a near-duplicate
+    THRESHOLD = 0.85
+    # Shorter texts are only deduplicated exactly; their signatures are too noisy
+    MIN_SHINGLES = 32
+    # Bounds the cost of huge generated files; their head is representative enough
+    MAX_TOKENS = 20000
+
+    TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+    _MASK = (1 << 64) - 1
+
+    def __init__(self):
+        self._exact = {}                    # digest -> key
+        self._signatures = {}               # key -> signature
+        self._buckets = defaultdict(list)   # (band, rows) -> [key, ...]
+        self._rows = self.NUM_BINS // self.BANDS
+
+    def fingerprint(self, content: str) -> Fingerprint:
+        normalized = "\n".join(line.rstrip() for line in content.splitlines()).strip()
+        digest = hashlib.blake2b(normalized.encode("utf-8", errors="ignore"), digest_size=16).digest()
+
+        tokens = self.TOKEN_PATTERN.findall(normalized)[:self.MAX_TOKENS]
+        shingle_count = len(tokens) - self.SHINGLE_SIZE + 1
+        if shingle_count < self.MIN_SHINGLES:
+            return Fingerprint(digest, None)
+
+        # Hash every shingle (C-level map/zip), then walk the hashes in ascending order:
+        # the first value that lands in a bin is that bin's minimum, and the walk can stop
+        # as soon as every bin is filled
+        token_hashes = list(map(hash, tokens))
+        shingles = zip(*(token_hashes[offset:] for offset in range(self.SHINGLE_SIZE)))
+        bins = [None] * self.NUM_BINS
+        empty = self.NUM_BINS
+        for value in sorted({shingle_hash & self._MASK for shingle_hash in map(hash, shingles)}):
+            index = value % self.NUM_BINS
+            if bins[index] is None:
+                bins[index] = value // self.NUM_BINS
+                empty -= 1
+                if not empty:
+                    break
+        return Fingerprint(digest, self._densify(bins))
+
+    def _densify(self, bins: List[Optional[int]]) -> Tuple[int, ...]:
+        # Empty bins borrow the next non-empty bin to the right (rotation densification),
+        # offset by the distance so borrowed values stay distinguishable
+        size = len(bins)
+        signature = list(bins)
+        for index in range(size):
+            if signature[index] is not None:
+                continue
+            for distance in range(1, size):
+                value = bins[(index + distance) % size]
+                if value is not None:
+                    signature[index] = value + distance * self._MASK
+                    break
+        return tuple(signature)
+
+    def find(self, fingerprint: Fingerprint) -> Optional[Tuple[str, float]]:
+        """
+        Returns (key of the indexed file it duplicates, estimated similarity), or None.
+        Exact copies have similarity 1.0.
+        """
+        key = self._exact.get(fingerprint.digest)
+        if key is not None:
+            return key, 1.0
+        if fingerprint.signature is None:
+            return None
+
+        band_matches = Counter()
+        for band in range(self.BANDS):
+            band_matches.update(self._buckets.get(self._band_key(fingerprint.signature, band), ()))
+
+        best = None
+        for candidate, matches in band_matches.items():
+            if matches < self.MIN_BAND_MATCHES:
+                continue
+            other = self._signatures[candidate]
+            similarity = sum(a == b for a, b in zip(fingerprint.signature, other)) / self.NUM_BINS
+            if similarity >= self.THRESHOLD and (best is None or similarity > best[1]):
+                # Not byte-identical, so never report a perfect match
+                best = (candidate, min(similarity, 0.99))
+        return best
+
+    def add(self, key: str, fingerprint: Fingerprint):
+        self._exact.setdefault(fingerprint.digest, key)
+        if fingerprint.signature is None:
+            return
+        self._signatures[key] = fingerprint.signature
+        for band in range(self.BANDS):
+            self._buckets[self._band_key(fingerprint.signature, band)].append(key)
+
+    def _band_key(self, signature: Tuple[int, ...], band: int) -> tuple:
+        return (band,) + signature[band * self._rows:(band + 1) * self._rows]
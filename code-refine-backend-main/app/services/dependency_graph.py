@@ -0,0 +1,221 @@
+import ast
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from app.services.python_analysis import extract_import_records
+
+logger = logging.getLogger(__name__)
+
+
+class DependencyGraphService:
+    """
+    Builds the import graph of a repository (Python via `ast`, JS/TS via regex)
+    and ranks files by PageRank, so modules that everything depends on score high
+    even when their names and paths look unremarkable.
+    Ranks are cached per commit SHA, which callers pass in from the checkout they made;
+    trees without one (uploads) are ranked every time. Git is never run on the tree itself.
+    """
+
+    PYTHON_EXTENSIONS = {'.py'}
+    JS_EXTENSIONS = ['.ts', '.tsx', '.js', '.jsx', '.mjs', '.cjs']
+    # Common source roots that are not part of the importable module name
+    SOURCE_ROOTS = {'src', 'lib', 'python'}
+
+    JS_IMPORT_PATTERN = re.compile(
+        r"""(?:\bfrom\s*|\bimport\s*\(?\s*|\brequire\s*\(\s*)['"]([^'"\n]+)['"]"""
+    )
+
+    def __init__(self, cache_size: int = 64):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # commit sha -> {rel_path: rank}
+        self._lock = threading.Lock()
+
+    def get_centrality(self, repo_path: str, files: List[Path],
+                       python_analyses: Optional[Dict[str, Dict[str, Any]]] = None,
+                       commit: Optional[str] = None) -> Dict[str, float]:
+        """
+        Returns {relative path: PageRank} for the given source files.
+        commit is the SHA checked out at repo_path, if any.
+        """
+        if commit:
+            with self._lock:
+                if commit in self._cache:
+                    self._cache.move_to_end(commit)
+                    return self._cache[commit]
+
+        graph = self.build_graph(Path(repo_path), files, python_analyses)
+        ranks = self.pagerank(graph)
+
+        if commit:
+            with self._lock:
+                self._cache[commit] = ranks
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return ranks
+
+    # --- Graph construction ---
+
+    def build_graph(self, repo_root: Path, files: List[Path],
+                    python_analyses: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, Set[str]]:
+        """
+        Returns an adjacency map {importer: {imported, ...}} of relative paths,
+        covering only imports that resolve to files inside the repository.
+        Import records already collected by PythonAnalysisService are reused.
+        """
+        rel_files = {}
+        python_modules = {}
+        for file_path in files:
+            rel_path = file_path.relative_to(repo_root).as_posix()
+            rel_files[rel_path] = file_path
+            if file_path.suffix in self.PYTHON_EXTENSIONS:
+                for module_name in self._python_module_names(rel_path):
+                    python_modules.setdefault(module_name, rel_path)
+
+        graph = {rel_path: set() for rel_path in rel_files}
+        for rel_path, file_path in rel_files.items():
+            analysis = (python_analyses or {}).get(os.path.normpath(str(file_path)))
+            if analysis and analysis["error"] is None:
+                targets = self._resolve_python_imports(analysis["imports"], rel_path, python_modules)
+                targets.discard(rel_path)
+                graph[rel_path].update(targets)
+                continue
+
+            try:
+                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                    source = f.read()
+            except Exception as e:
+                logger.debug(f"Skipping {file_path} in import graph: {e}")
+                continue
+
+            if file_path.suffix in self.PYTHON_EXTENSIONS:
+                targets = self._python_imports(source, rel_path, python_modules)
+            else:
+                targets = self._js_imports(source, rel_path, rel_files)
+            targets.discard(rel_path)
+            graph[rel_path].update(targets)
+
+        return graph
+
+    def _python_module_names(self, rel_path: str) -> List[str]:
+        parts = rel_path[:-3].split('/')
+        if parts[-1] == '__init__':
+            parts = parts[:-1]
+        if not parts:
+            return []
+        names = ['.'.join(parts)]
+        if len(parts) > 1 and parts[0] in self.SOURCE_ROOTS:
+            names.append('.'.join(parts[1:]))
+        return names
+
+    def _python_imports(self, source: str, rel_path: str, modules: Dict[str, str]) -> Set[str]:
+        try:
+            tree = ast.parse(source)
+        except (SyntaxError, ValueError, RecursionError, MemoryError):
+            return set()
+
+        return self._resolve_python_imports(extract_import_records(tree), rel_path, modules)
+
+    def _resolve_python_imports(self, records: List[tuple], rel_path: str, modules: Dict[str, str]) -> Set[str]:
+        # Directory of the file is the package relative imports start from
+        package = rel_path.split('/')[:-1]
+
+        candidates = []
+        for level, module, names in records:
+            if module is None and level == 0:
+                candidates.extend(names)  # plain `import a.b`
+                continue
+            if level:
+                base_parts = package[:max(0, len(package) - (level - 1))]
+                base = '.'.join(base_parts + ([module] if module else []))
+            else:
+                base = module or ''
+            for name in names:
+                # `from pkg import mod` may name a submodule
+                candidates.append(f"{base}.{name}" if base else name)
+            if base:
+                candidates.append(base)
+
+        targets = set()
+        for name in candidates:
+            # Resolve the longest prefix that is a module in this repo
+            parts = name.split('.')
+            while parts:
+                target = modules.get('.'.join(parts))
+                if target:
+                    targets.add(target)
+                    break
+                parts.pop()
+        return targets
+
+    def _js_imports(self, source: str, rel_path: str, rel_files: Dict[str, Path]) -> Set[str]:
+        targets = set()
+        importer_dir = os.path.dirname(rel_path)
+        for specifier in self.JS_IMPORT_PATTERN.findall(source):
+            if specifier.startswith('.'):
+                bases = [os.path.normpath(os.path.join(importer_dir, specifier))]
+            elif specifier.startswith('@/') or specifier.startswith('~/'):
+                # Common project-root aliases (Next.js, Vite, Nuxt)
+                bases = [specifier[2:], f"src/{specifier[2:]}"]
+            else:
+                continue  # Package import, outside the repository
+
+            for base in bases:
+                base = base.replace(os.sep, '/')
+                resolved = self._resolve_js_path(base, rel_files)
+                if resolved:
+                    targets.add(resolved)
+                    break
+        return targets
+
+    def _resolve_js_path(self, base: str, rel_files: Dict[str, Path]) -> Optional[str]:
+        if base in rel_files:
+            return base
+        for extension in self.JS_EXTENSIONS:
+            if base + extension in rel_files:
+                return base + extension
+        for extension in self.JS_EXTENSIONS:
+            index_path = f"{base}/index{extension}"
+            if index_path in rel_files:
+                return index_path
+        return None
+
+    # --- Ranking ---
+
+    def pagerank(self, graph: Dict[str, Set[str]], damping: float = 0.85,
+                 max_iterations: int = 50, tolerance: float = 1.0e-6) -> Dict[str, float]:
+        """
+        Standard power-iteration PageRank. Edges point from importer to imported,
+        so rank flows towards widely used modules. Ranks sum to 1.
+        """
+        nodes = list(graph)
+        count = len(nodes)
+        if count == 0:
+            return {}
+
+        incoming = {node: [] for node in nodes}
+        for source, targets in graph.items():
+            for target in targets:
+                incoming[target].append(source)
+        out_degree = {node: len(graph[node]) for node in nodes}
+
+        ranks = {node: 1.0 / count for node in nodes}
+        for _ in range(max_iterations):
+            dangling = sum(ranks[node] for node in nodes if out_degree[node] == 0)
+            base = (1.0 - damping) / count + damping * dangling / count
+            new_ranks = {
+                node: base + damping * sum(ranks[source] / out_degree[source] for source in incoming[node])
+                for node in nodes
+            }
+            delta = sum(abs(new_ranks[node] - ranks[node]) for node in nodes)
+            ranks = new_ranks
+            if delta < tolerance:
+                break
+        return ranks
+
+
+dependency_graph = DependencyGraphService()
@@ -1,37 +1,81 @@
 import os
-import shutil
-import tempfile
-import git
 import ast
 import re
-import tiktoken
+from functools import lru_cache
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from app.core.settings import settings
+from app.services.cancellation import AnalysisCancelledError, CancelToken
+from app.services.dedup import DuplicateIndex
+from app.services.dependency_graph import dependency_graph
+from app.services.python_analysis import PythonAnalysisService, SkeletonVisitor
+from app.services.workspace_manager import WorkspaceError, workspace_manager
+
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    """
+    Loads the cl100k_base tokenizer (used by GPT-4, Llama 3, etc.) once per process.
+    tiktoken reads the BPE file from TIKTOKEN_CACHE_DIR (baked into the Docker image) and
+    downloads it otherwise; a failed load is cached too, so hosts without egress fall back
+    to approximate counts instead of retrying the download on every request.
+    """
+    if settings.tiktoken_cache_dir:
+        os.environ.setdefault("TIKTOKEN_CACHE_DIR", settings.tiktoken_cache_dir)
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"Tokenizer unavailable, approximating token counts: {e}")
+        return None
+
 
 class GitHubService:
+    ALLOWED_EXTENSIONS = {'.py', '.js', '.ts', '.tsx', '.jsx', '.java', '.cpp', '.c', '.cs', '.go', '.rs', '.php', '.rb', '.html', '.css', '.scss', '.vue', '.svelte', '.json', '.xml', '.yaml', '.yml', '.md'}
+    IGNORED_DIRS = {'.git', 'node_modules', 'venv', '__pycache__', 'dist', 'build', '.next', '.idea', '.vscode'}
+    # Max score bonus for the most imported module in the repo
+    CENTRALITY_WEIGHT = 60
+    # Context packing, from richest to cheapest (see BudgetController.run_with_ladder)
+    PACKING_LEVELS = ["full", "skeleton", "signatures", "top_files"]
+    TOP_FILES_LIMIT = 10
+    # Per packing level: lines of context around changed hunks, and whether neighbors are included
+    DIFF_PACKING = {
+        "full": (10, True),
+        "skeleton": (3, True),
+        "signatures": (0, False),
+        "top_files": (0, False),
+    }
+    # Findings-guided windows (bandit issues, radon D/E/F functions): share of the context budget
+    # they may use, lines shown around a finding outside any function, and the longest function
+    # shown whole
+    HOTSPOT_SHARE = 0.25
+    HOTSPOT_PADDING = 3
+    HOTSPOT_MAX_FUNCTION_LINES = 80
+    HOTSPOT_SEVERITY_WEIGHTS = {"HIGH": 100, "MEDIUM": 60, "LOW": 20}
+    HOTSPOT_CONFIDENCE_FACTORS = {"HIGH": 1.0, "MEDIUM": 0.7, "LOW": 0.4}
+    HOTSPOT_RANK_WEIGHTS = {"D": 40, "E": 60, "F": 80}
+    # Appended to a file's header once it has duplicates, followed by their comma-separated paths
+    ALIASES_PREFIX = "; identical or similar copies: "
+
     def __init__(self):
-        self.temp_dir = tempfile.gettempdir()
-        # Initialize tokenizer for cl100k_base (used by GPT-4, Llama 3, etc.)
-        try:
-            self.tokenizer = tiktoken.get_encoding("cl100k_base")
-        except:
-            # Fallback if tiktoken fails (though it shouldn't)
-            self.tokenizer = None
+        self.workspaces = workspace_manager
+        self.dependency_graph = dependency_graph
+        self.tokenizer = get_tokenizer()
+        # repo path -> (token cap, rendered hotspots, complete?); every packing level asks again
+        self._hotspot_cache = {}
 
-    def clone_repository(self, repo_url: str) -> str:
+    def clone_repository(self, repo_url: str, ref: str = None, job_dir: str = None,
+                         cancel_token: CancelToken = None) -> str:
         """
-        Clones a GitHub repository to a temporary directory.
-        Returns the path to the cloned repository.
+        Checks out a GitHub repository into an isolated per-job workspace.
+        If a ref (branch, tag or commit SHA) is given, it is checked out instead of the default branch.
+        Pass a directory from `workspaces.reserve()` as job_dir to be able to release it mid-clone.
+        Returns the path to the checkout.
         """
-        repo_name = repo_url.split("/")[-1].replace(".git", "")
-        target_dir = os.path.join(self.temp_dir, "code_refine_repos", repo_name)
-        
-        # Clean up if exists
-        if os.path.exists(target_dir):
-            shutil.rmtree(target_dir)
-            
         try:
-            git.Repo.clone_from(repo_url, target_dir)
-            return target_dir
+            return self.workspaces.checkout(repo_url, ref=ref, job_dir=job_dir, cancel_token=cancel_token)
+        except (AnalysisCancelledError, WorkspaceError):
+            # WorkspaceError is the caller's fault (unknown or invalid ref): callers map it to 400
+            raise
         except Exception as e:
             raise Exception(f"Failed to clone repository: {str(e)}")
 
@@ -55,34 +99,30 @@ class GitHubService:
             print(f"Skeleton extraction failed: {e}")
             return code # Fallback to full code
 
+    def _extract_signatures(self, skeleton: str, extension: str) -> str:
+        """
+        Reduces a skeleton to declaration lines only (no docstrings or comments).
+        Non-code files are cut to their first lines.
+        """
+        if extension == '.py':
+            prefixes = ('def ', 'async def ', 'class ', '@', 'import ', 'from ')
+        elif extension in ['.js', '.ts', '.jsx', '.tsx']:
+            prefixes = ('import', 'export', 'class', 'function')
+        else:
+            return "\n".join(skeleton.split('\n')[:20])
+
+        return "\n".join(
+            line for line in skeleton.split('\n')
+            if line.strip().startswith(prefixes) or (extension != '.py' and '=>' in line)
+        )
+
     def _skeletonize_python(self, code: str) -> str:
         try:
             tree = ast.parse(code)
         except SyntaxError:
             return code
 
-        class SkeletonVisitor(ast.NodeTransformer):
-            def visit_FunctionDef(self, node):
-                # Keep docstring
-                docstring = ast.get_docstring(node)
-                new_body = []
-                if docstring:
-                    new_body.append(ast.Expr(value=ast.Constant(value=docstring)))
-                new_body.append(ast.Expr(value=ast.Constant(value="...")))
-                node.body = new_body
-                return node
-
-            def visit_AsyncFunctionDef(self, node):
-                return self.visit_FunctionDef(node)
-
-            def visit_ClassDef(self, node):
-                # Process methods inside class
-                self.generic_visit(node)
-                return node
-
-        visitor = SkeletonVisitor()
-        new_tree = visitor.visit(tree)
-        return ast.unparse(new_tree)
+        return ast.unparse(SkeletonVisitor().visit(tree))
 
     def _skeletonize_js(self, code: str) -> str:
         # Simple Regex-based skeletonizer for JS/TS
@@ -140,17 +180,63 @@ class GitHubService:
         
         return score
 
-    def get_repository_content(self, repo_path: str, max_tokens: int = 12000) -> str:
+    def _is_full_code(self, score: int, packing: str) -> bool:
+        # Score >= 80: Full Code (Critical); everything else, and every cheaper level, gets a skeleton
+        return score >= 80 and packing == "full"
+
+    def _apply_centrality(self, repo_path: str, scored_files: list, source_files: list,
+                          python_analyses: Optional[Dict[str, Dict[str, Any]]] = None,
+                          commit: Optional[str] = None) -> list:
+        """
+        Adds up to CENTRALITY_WEIGHT points to each scored file based on its
+        PageRank in the import graph, normalized between the least and most central file.
+        """
+        graph_extensions = self.dependency_graph.PYTHON_EXTENSIONS | set(self.dependency_graph.JS_EXTENSIONS)
+        graph_files = [p for p in source_files if p.suffix in graph_extensions]
+        try:
+            ranks = self.dependency_graph.get_centrality(
+                repo_path, graph_files, python_analyses=python_analyses, commit=commit
+            )
+        except Exception as e:
+            print(f"Import graph failed, using heuristic scores only: {e}")
+            return scored_files
+        if not ranks:
+            return scored_files
+
+        min_rank, max_rank = min(ranks.values()), max(ranks.values())
+        if max_rank <= min_rank:
+            return scored_files
+
+        repo_path_obj = Path(repo_path)
+        boosted = []
+        for score, file_path in scored_files:
+            rank = ranks.get(file_path.relative_to(repo_path_obj).as_posix())
+            if rank is not None:
+                score += round(self.CENTRALITY_WEIGHT * (rank - min_rank) / (max_rank - min_rank))
+            boosted.append((score, file_path))
+        return boosted
+
+    def get_repository_content(self, repo_path: str, max_tokens: int = 12000,
+                               python_analyses: Optional[Dict[str, Dict[str, Any]]] = None,
+                               packing: str = "full", commit: Optional[str] = None) -> str:
         """
         Smartly selects and compresses repository content to fit within max_tokens.
         Uses AST Skeleton for non-critical files.
+        python_analyses (from PythonAnalysisService) supplies pre-built skeletons and imports
+        so Python files are not parsed again here.
+        packing (one of PACKING_LEVELS) trades detail for size: "skeleton" never includes
+        full files, "signatures" keeps declarations only, "top_files" also stops after
+        TOP_FILES_LIMIT files.
+        commit is the SHA checked out at repo_path (None for uploads); it keys the import-graph cache.
         """
-        allowed_extensions = {'.py', '.js', '.ts', '.tsx', '.jsx', '.java', '.cpp', '.c', '.cs', '.go', '.rs', '.php', '.rb', '.html', '.css', '.scss', '.vue', '.svelte', '.json', '.xml', '.yaml', '.yml', '.md'}
-        ignored_dirs = {'.git', 'node_modules', 'venv', '__pycache__', 'dist', 'build', '.next', '.idea', '.vscode'}
-        
+        allowed_extensions = self.ALLOWED_EXTENSIONS
+        ignored_dirs = self.IGNORED_DIRS
+
         repo_path_obj = Path(repo_path)
         scored_files = []
-        
+        # Every source file (even score 0, e.g. tests) contributes import edges
+        source_files = []
+
         # 1. Scan and Score all files
         for root, dirs, files in os.walk(repo_path):
             dirs[:] = [d for d in dirs if d not in ignored_dirs]
@@ -158,73 +244,401 @@ class GitHubService:
             for file in files:
                 file_path = Path(root) / file
                 if file_path.suffix in allowed_extensions:
+                    source_files.append(file_path)
                     score = self._get_file_score(file_path, repo_path_obj)
                     if score > 0:
                         scored_files.append((score, file_path))
-        
-        # 2. Sort by Score (Desc)
+
+        # 2. Boost modules the rest of the code depends on (import-graph PageRank)
+        scored_files = self._apply_centrality(repo_path, scored_files, source_files, python_analyses, commit)
+
+        # 3. Sort by Score (Desc)
         scored_files.sort(key=lambda x: x[0], reverse=True)
         
         content_buffer = []
         current_tokens = 0
         # Reserve 1000 tokens for system prompt and JSON overhead
         token_limit = max_tokens - 1000 
+
+        # 4. Keep an allowance for the code around static-analysis findings (packed after the files).
+        # Files sent in full already contain theirs, so only hotspots elsewhere count towards it
+        hotspots = self._render_hotspots(repo_path, python_analyses, token_limit) if python_analyses else []
+        full_candidates = {
+            file_path.relative_to(repo_path_obj).as_posix()
+            for score, file_path in scored_files if self._is_full_code(score, packing)
+        }
+        hotspot_allowance = min(
+            int(token_limit * self.HOTSPOT_SHARE),
+            sum(h["tokens"] for h in hotspots if h["rel_path"] not in full_candidates)
+        )
+        file_limit = token_limit - hotspot_allowance
+        full_files = set()
+        # Vendored copies and near-duplicates collapse into the first selected file, which lists them
+        duplicates = DuplicateIndex()
+        entries = {}  # rel path -> {"header", "content", "aliases"}
+        exact_aliases = set()
         
         selected_files_count = 0
         
         for score, file_path in scored_files:
-            if current_tokens >= token_limit:
+            if current_tokens >= file_limit:
+                break
+            if packing == "top_files" and selected_files_count >= self.TOP_FILES_LIMIT:
                 break
 
             try:
                 with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
                     file_content = f.read()
+                    rel_path = file_path.relative_to(repo_path_obj).as_posix()
+
+                    # Already selected (or nearly identical to something selected): just note the alias
+                    fingerprint = duplicates.fingerprint(file_content)
+                    match = duplicates.find(fingerprint)
+                    if match:
+                        canonical, similarity = match
+                        alias = rel_path if similarity == 1.0 else f"{rel_path} (~{similarity:.0%} similar)"
+                        # The first alias also brings the prefix into the header
+                        separator = ", " if entries[canonical]["aliases"] else self.ALIASES_PREFIX
+                        alias_tokens = self._get_token_count(f"{separator}{alias}")
+                        if current_tokens + alias_tokens <= file_limit:
+                            entries[canonical]["aliases"].append(alias)
+                            current_tokens += alias_tokens
+                        if similarity == 1.0:
+                            exact_aliases.add(rel_path)
+                        continue
                     
                     # DECISION: Full Code vs Skeleton
                     # Score >= 80: Full Code (Critical)
                     # Score < 80: Skeleton (Context)
                     
-                    is_full_code = score >= 80
+                    is_full_code = self._is_full_code(score, packing)
                     processed_content = file_content
                     
                     if not is_full_code:
-                        processed_content = self._extract_skeleton(file_content, file_path.suffix)
+                        analysis = (python_analyses or {}).get(os.path.normpath(str(file_path)))
+                        if analysis and analysis["skeleton"] is not None:
+                            processed_content = analysis["skeleton"]
+                        else:
+                            processed_content = self._extract_skeleton(file_content, file_path.suffix)
                         header_tag = "SKELETON"
+                        if packing in ("signatures", "top_files"):
+                            processed_content = self._extract_signatures(processed_content, file_path.suffix)
+                            header_tag = "SIGNATURES"
                     else:
                         header_tag = "FULL"
 
-                    header = f"\n\n--- FILE: {file_path.relative_to(repo_path_obj)} ({header_tag}, Score: {score}) ---\n\n"
-                    entry_text = header + processed_content
+                    header = f"--- FILE: {rel_path} ({header_tag}, Score: {score}"
+                    entry_text = f"\n\n{header}) ---\n\n" + processed_content
                     entry_tokens = self._get_token_count(entry_text)
                     
-                    if current_tokens + entry_tokens > token_limit:
+                    if current_tokens + entry_tokens > file_limit:
                         # Try to fit at least the header? No, cleaner to skip.
                         continue
                         
-                    content_buffer.append(entry_text)
+                    entries[rel_path] = {"header": header, "content": processed_content, "aliases": []}
+                    duplicates.add(rel_path, fingerprint)
                     current_tokens += entry_tokens
                     selected_files_count += 1
+                    if is_full_code:
+                        full_files.add(rel_path)
                     
             except Exception as e:
                 print(f"Error reading file {file_path}: {e}")
                 continue
+
+        for entry in entries.values():
+            aliases = f"{self.ALIASES_PREFIX}{', '.join(entry['aliases'])}" if entry["aliases"] else ""
+            content_buffer.append(f"\n\n{entry['header']}{aliases}) ---\n\n{entry['content']}")
+
+        # 5. Hotspots get the allowance plus whatever the files left over; files sent in full
+        # (and exact copies of selected files) already contain them
+        hotspot_buffer = []
+        for hotspot in hotspots:
+            if hotspot["rel_path"] in full_files or hotspot["rel_path"] in exact_aliases:
+                continue
+            if current_tokens + hotspot["tokens"] > token_limit:
+                continue
+            hotspot_buffer.append(hotspot["text"])
+            current_tokens += hotspot["tokens"]
                 
-        print(f"DEBUG: Selected {selected_files_count} files. Total Tokens: {current_tokens}/{token_limit}")
+        alias_count = sum(len(entry["aliases"]) for entry in entries.values())
+        print(f"DEBUG: Selected {selected_files_count} files ({alias_count} duplicates folded in) and {len(hotspot_buffer)} hotspots. Total Tokens: {current_tokens}/{token_limit}")
+        return "".join(hotspot_buffer) + "".join(content_buffer)
+
+    def _collect_hotspots(self, repo_path: str, python_analyses: Dict[str, Dict[str, Any]]) -> Dict[str, List[dict]]:
+        """
+        Returns {relative path: [window, ...]} with a line window per bandit issue (its enclosing
+        function when that is short enough) and per function radon ranks D or worse.
+        A window is {"start", "end", "score", "reasons"}.
+        Files the selector scores 0 (tests, migrations, examples) are skipped, and so are
+        bandit's assert warnings (B101) in test modules living elsewhere.
+        """
+        windows = {}
+        repo_root = Path(repo_path)
+        for path, analysis in python_analyses.items():
+            if analysis["error"] is not None:
+                continue
+            if self._get_file_score(Path(path), repo_root) == 0:
+                continue
+            filename = os.path.basename(path)
+            is_test_module = filename.startswith("test_") or filename.endswith("_test.py") or filename == "conftest.py"
+            functions = []
+            pending = list(analysis["blocks"])
+            while pending:
+                block = pending.pop()
+                if block.get("type") in ("function", "method"):
+                    functions.append(block)
+                    pending.extend(block.get("closures", []))
+
+            file_windows = []
+            for issue in analysis["issues"]:
+                if is_test_module and issue.get("test_id") == "B101":
+                    continue
+                line_range = issue.get("line_range") or [issue.get("line_number", 1)]
+                start, end = min(line_range), max(line_range)
+                enclosing = [
+                    block for block in functions
+                    if block["lineno"] <= start and end <= block["endline"]
+                    and block["endline"] - block["lineno"] < self.HOTSPOT_MAX_FUNCTION_LINES
+                ]
+                if enclosing:
+                    block = min(enclosing, key=lambda b: b["endline"] - b["lineno"])
+                    start, end = block["lineno"], block["endline"]
+                else:
+                    start, end = max(1, start - self.HOTSPOT_PADDING), end + self.HOTSPOT_PADDING
+                severity = issue.get("issue_severity", "LOW")
+                confidence = issue.get("issue_confidence", "LOW")
+                file_windows.append({
+                    "start": start,
+                    "end": end,
+                    "score": self.HOTSPOT_SEVERITY_WEIGHTS.get(severity, 0) * self.HOTSPOT_CONFIDENCE_FACTORS.get(confidence, 0.4),
+                    "reasons": [f"Bandit {issue.get('test_id')} {severity}: {issue.get('issue_text')}"],
+                })
+
+            for block in functions:
+                if block.get("rank") not in self.HOTSPOT_RANK_WEIGHTS:
+                    continue
+                # Very long functions: the signature and the first lines carry most of the signal
+                end = min(block["endline"], block["lineno"] + self.HOTSPOT_MAX_FUNCTION_LINES - 1)
+                file_windows.append({
+                    "start": block["lineno"],
+                    "end": end,
+                    "score": self.HOTSPOT_RANK_WEIGHTS[block["rank"]] + block.get("complexity", 0),
+                    "reasons": [f"Radon {block['rank']} ({block.get('complexity')}) in {block.get('name')}"],
+                })
+
+            if file_windows:
+                windows[os.path.relpath(path, repo_path).replace(os.sep, '/')] = self._merge_windows(file_windows)
+        return windows
+
+    def _merge_windows(self, windows: List[dict]) -> List[dict]:
+        # Overlapping or adjacent windows become one; their scores add up
+        merged = []
+        for window in sorted(windows, key=lambda w: (w["start"], w["end"])):
+            if merged and window["start"] <= merged[-1]["end"] + 1:
+                last = merged[-1]
+                last["end"] = max(last["end"], window["end"])
+                last["score"] += window["score"]
+                last["reasons"].extend(r for r in window["reasons"] if r not in last["reasons"])
+            else:
+                merged.append(dict(window, reasons=list(window["reasons"])))
+        return merged
+
+    def _render_hotspots(self, repo_path: str, python_analyses: Dict[str, Dict[str, Any]], max_tokens: int) -> List[dict]:
+        """
+        Renders the merged windows with line numbers, most important first, until max_tokens
+        worth is rendered (nothing beyond that could be packed). Files are read lazily and the
+        result is cached per checkout for the cheaper packing levels.
+        Returns [{"rel_path", "text", "tokens", "score"}, ...].
+        """
+        cached = self._hotspot_cache.get(repo_path)
+        if cached is not None and (cached[0] >= max_tokens or cached[2]):
+            return cached[1]
+
+        windows = [
+            (rel_path, window)
+            for rel_path, file_windows in self._collect_hotspots(repo_path, python_analyses).items()
+            for window in file_windows
+        ]
+        # Highest score first; among equals, the shorter window
+        windows.sort(key=lambda item: (-item[1]["score"], item[1]["end"] - item[1]["start"]))
+
+        rendered = []
+        rendered_tokens = 0
+        file_lines = {}
+        for rel_path, window in windows:
+            if rendered_tokens >= max_tokens:
+                break
+            if rel_path not in file_lines:
+                try:
+                    with open(os.path.join(repo_path, rel_path), 'r', encoding='utf-8', errors='ignore') as f:
+                        file_lines[rel_path] = f.read().splitlines()
+                except OSError:
+                    file_lines[rel_path] = []
+            lines = file_lines[rel_path]
+            end = min(window["end"], len(lines))
+            if window["start"] > end:
+                continue
+            body = "\n".join(f"{number:>5} | {lines[number - 1]}" for number in range(window["start"], end + 1))
+            header = f"\n\n--- HOTSPOT: {rel_path} lines {window['start']}-{end} ({'; '.join(window['reasons'])}) ---\n\n"
+            text = header + body
+            tokens = self._get_token_count(text)
+            rendered.append({"rel_path": rel_path, "text": text, "tokens": tokens, "score": window["score"]})
+            rendered_tokens += tokens
+
+        complete = len(rendered) == len(windows) or rendered_tokens < max_tokens
+        self._hotspot_cache[repo_path] = (max_tokens, rendered, complete)
+        return rendered
+
+    def get_changed_lines(self, repo_path: str, base_ref: str, head_ref: str,
+                          cancel_token: CancelToken = None) -> Dict[str, List[Tuple[int, int]]]:
+        """
+        Returns the files changed between base_ref and head_ref (PR semantics: base...head)
+        mapped to the (start, end) line ranges touched in the head version.
+        Pure deletions are recorded as a single-line range at the deletion point.
+        """
+        diff_text = self.workspaces.diff(repo_path, base_ref, head_ref, cancel_token=cancel_token)
+
+        changed = {}
+        current_file = None
+        hunk_header = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+        for line in diff_text.splitlines():
+            if line.startswith("+++ "):
+                path = line[4:].rstrip("\t")
+                current_file = path[2:] if path.startswith("b/") else None
+                if current_file:
+                    changed.setdefault(current_file, [])
+                continue
+            match = hunk_header.match(line)
+            if match and current_file:
+                start = int(match.group(1))
+                length = int(match.group(2)) if match.group(2) is not None else 1
+                end = start + max(length, 1) - 1
+                changed[current_file].append((max(start, 1), max(end, 1)))
+        return changed
+
+    def _merge_ranges(self, ranges: List[Tuple[int, int]], padding: int, max_line: int) -> List[Tuple[int, int]]:
+        merged = []
+        for start, end in sorted(ranges):
+            start, end = max(1, start - padding), min(max_line, end + padding)
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def get_diff_content(self, repo_path: str, changed_lines: Dict[str, List[Tuple[int, int]]], max_tokens: int = 12000, packing: str = "full") -> str:
+        """
+        Builds the LLM context for a diff review: the changed hunks of every changed file
+        (with a few lines of surrounding context, changed lines marked with '+'),
+        followed by skeletons of unchanged neighbor files from the same directories.
+        Cheaper packing levels shrink the hunk context and drop neighbors (see DIFF_PACKING).
+        """
+        context_lines, include_neighbors = self.DIFF_PACKING.get(packing, self.DIFF_PACKING["full"])
+        repo_path_obj = Path(repo_path)
+        content_buffer = []
+        current_tokens = 0
+        # Reserve 1000 tokens for system prompt and JSON overhead
+        token_limit = max_tokens - 1000
+
+        # 1. Changed hunks, biggest changes first
+        ordered = sorted(
+            changed_lines.items(),
+            key=lambda item: sum(end - start + 1 for start, end in item[1]),
+            reverse=True,
+        )
+        if packing == "top_files":
+            ordered = ordered[:self.TOP_FILES_LIMIT]
+        for rel_path, ranges in ordered:
+            file_path = repo_path_obj / rel_path
+            if file_path.suffix not in self.ALLOWED_EXTENSIONS or not file_path.is_file():
+                continue
+            try:
+                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                    lines = f.read().splitlines()
+            except Exception as e:
+                print(f"Error reading file {file_path}: {e}")
+                continue
+
+            changed_set = {n for start, end in ranges for n in range(start, end + 1)}
+            windows = self._merge_ranges(ranges, context_lines, len(lines))
+            chunks = []
+            for start, end in windows:
+                chunks.append("\n".join(
+                    f"{'+' if n in changed_set else ' '}{n:5d} | {lines[n - 1]}"
+                    for n in range(start, end + 1)
+                ))
+            line_info = ", ".join(f"{start}-{end}" for start, end in windows)
+            header = f"\n\n--- FILE: {rel_path} (DIFF, Lines: {line_info}) ---\n\n"
+            entry_text = header + "\n...\n".join(chunks)
+            entry_tokens = self._get_token_count(entry_text)
+
+            if current_tokens + entry_tokens > token_limit:
+                continue
+            content_buffer.append(entry_text)
+            current_tokens += entry_tokens
+
+        # 2. Skeletons of neighbors (same directory as a changed file)
+        neighbors = []
+        neighbor_dirs = {(repo_path_obj / rel_path).parent for rel_path in changed_lines} if include_neighbors else set()
+        for directory in neighbor_dirs:
+            if not directory.is_dir():
+                continue
+            for file_path in directory.iterdir():
+                rel_path = file_path.relative_to(repo_path_obj)
+                if (not file_path.is_file() or file_path.suffix not in self.ALLOWED_EXTENSIONS
+                        or str(rel_path) in changed_lines):
+                    continue
+                score = self._get_file_score(file_path, repo_path_obj)
+                if score > 0:
+                    neighbors.append((score, file_path))
+        neighbors.sort(key=lambda x: x[0], reverse=True)
+
+        for score, file_path in neighbors:
+            if current_tokens >= token_limit:
+                break
+            try:
+                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                    processed_content = self._extract_skeleton(f.read(), file_path.suffix)
+            except Exception as e:
+                print(f"Error reading file {file_path}: {e}")
+                continue
+
+            header = f"\n\n--- FILE: {file_path.relative_to(repo_path_obj)} (SKELETON, Neighbor) ---\n\n"
+            entry_text = header + processed_content
+            entry_tokens = self._get_token_count(entry_text)
+            if current_tokens + entry_tokens > token_limit:
+                continue
+            content_buffer.append(entry_text)
+            current_tokens += entry_tokens
+
+        print(f"DEBUG: Diff context for {len(changed_lines)} changed files. Total Tokens: {current_tokens}/{token_limit}")
         return "".join(content_buffer)
 
-    def clone_and_prepare(self, repo_url: str, max_tokens: int) -> tuple:
+    def clone_and_prepare(self, repo_url: str, ref: str = None, job_dir: str = None,
+                          cancel_token: CancelToken = None) -> tuple:
         """
-        Clones the repo and prepares the content string respecting the token limit.
-        Returns (repo_path, code_content)
+        Clones the repo and runs the shared Python analysis pass over it.
+        Returns (repo_path, python_analyses); pass python_analyses on to
+        StaticAnalysisService and get_repository_content so the files are not parsed again.
+        The context itself is built afterwards, once the size of the static-analysis
+        section it shares the budget with is known.
+        With a cancel_token the clone and the analysis pass run under its "clone" and
+        "static" deadlines, and cancellation is raised instead of returning (None, None).
         """
+        cancel_token = cancel_token or CancelToken()
         try:
-            repo_path = self.clone_repository(repo_url)
-            code_content = self.get_repository_content(repo_path, max_tokens=max_tokens)
-            return repo_path, code_content
+            with cancel_token.stage("clone"):
+                repo_path = self.clone_repository(repo_url, ref=ref, job_dir=job_dir, cancel_token=cancel_token)
+            with cancel_token.stage("static"):
+                python_analyses = PythonAnalysisService().analyze_repository(repo_path, cancel_token=cancel_token)
+            return repo_path, python_analyses
         except Exception as e:
-            print(f"Error in clone_and_prepare: {e}")
             if 'repo_path' in locals() and repo_path:
                 self.cleanup(repo_path)
+            if isinstance(e, AnalysisCancelledError):
+                raise
+            print(f"Error in clone_and_prepare: {e}")
             return None, None
 
     def cleanup(self, repo_path: str):
@@ -232,10 +646,9 @@ class GitHubService:
 
     def cleanup_repository(self, repo_path: str):
         """
-        Removes the cloned repository from the temporary directory.
+        Removes the job's checkout from the workspace.
         """
-        if os.path.exists(repo_path):
-            try:
-                shutil.rmtree(repo_path)
-            except Exception as e:
-                print(f"Error cleaning up repository {repo_path}: {e}")
+        try:
+            self.workspaces.release(repo_path)
+        except Exception as e:
+            print(f"Error cleaning up repository {repo_path}: {e}")
@@ -1,17 +1,55 @@
 import os
-from groq import Groq
 import logging
 import json
+import re
+from app.api.schemas import AnalysisReport
+from app.services.cancellation import AnalysisCancelledError, CancelToken
+from app.services.report_repair import salvage_report
 
 logger = logging.getLogger(__name__)
 
+
+class ContextOverflowError(Exception):
+    """
+    The provider rejected the request because of its size or the token rate limit
+    (413 / 429 / context length exceeded). The caller can retry with a smaller context.
+    """
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RateLimitError(Exception):
+    """
+    The provider's token/request rate limit was hit (429) by a request that would fit
+    on its own. Waiting retry_after seconds helps; a smaller context does not.
+    """
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
 class LLMService:
+    # Report sections the model is asked for (incomplete_sections is filled in by us)
+    REPORT_SECTIONS = [name for name in AnalysisReport.model_fields if name != "incomplete_sections"]
+    MAX_TOKENS = 6000
+
     def __init__(self):
+        # Imported here: the Groq SDK (and its pydantic models) is the slowest import of the app
+        from groq import Groq
         self.client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+        # Prompt tokens the provider reported for the last analyze_code call (fed to the budget controller)
+        self.last_prompt_tokens = None
 
-    def analyze_code(self, file_content: str, static_analysis: dict, model_id: str) -> str:
+    def analyze_code(self, file_content: str, static_analysis: dict, model_id: str, review_scope: str = None,
+                     cancel_token: CancelToken = None) -> str:
         """
         Analyzes code using Groq LLM and returns a Structured JSON string.
+        review_scope, if given, narrows the audit (e.g. to the changed lines of a pull request).
+        If cancel_token is cancelled mid-call, the HTTP connection is closed and the
+        cancellation is raised instead of waiting for the completion.
+        Output cut off at max_tokens is repaired, and only the missing sections are
+        requested again (see _repair_report).
         """
         
         # --- ENTERPRISE-GRADE "EXHAUSTIVE" PROMPT ---
@@ -26,6 +64,7 @@ class LLMService:
         2. **Specificity:** You MUST quote the specific variable names, function names, and file names.
         3. **Code Snippets:** For Refactoring Suggestions, you MUST provide the `code_before` (the bad code) and `code_after` (the fixed code). Do not leave them empty.
         4. **Scoring:** Provide a strict Quality Score between 0 and 100.
+        5. **Hotspots:** HOTSPOT sections contain the exact code Bandit flagged and the most complex functions Radon found, with line numbers. Base `security_analysis` and your refactorings on that code.
 
         JSON STRUCTURE (Strict):
         {
@@ -51,7 +90,12 @@ class LLMService:
         }
         """
 
-        user_prompt = f"""
+        scope_section = f"""
+        [REVIEW SCOPE]
+        {review_scope}
+        """ if review_scope else ""
+
+        user_prompt = f"""{scope_section}
         [STATIC ANALYSIS REPORT (BANDIT/RADON)]
         {json.dumps(static_analysis)}
 
@@ -61,25 +105,124 @@ class LLMService:
         Perform the exhaustive audit now. Return ONLY Valid JSON.
         """
 
+        from groq import APIStatusError
+
+        self.last_prompt_tokens = None
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        try:
+            content, finish_reason, self.last_prompt_tokens = self._complete(messages, model_id, cancel_token)
+        except AnalysisCancelledError:
+            raise
+        except APIStatusError as e:
+            if e.status_code == 429 and not self._exceeds_limit(str(e)):
+                logger.warning(f"LLM rate limit hit for {model_id}")
+                raise RateLimitError(str(e), retry_after=self._retry_after(e))
+            if e.status_code in (413, 429) or "context_length" in str(e):
+                logger.warning(f"LLM rejected request size for {model_id}: {e.status_code}")
+                raise ContextOverflowError(str(e), status_code=e.status_code if e.status_code in (413, 429) else 413)
+            logger.error(f"LLM Analysis failed: {e}")
+            return self._failure_report()
+        except Exception as e:
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            logger.error(f"LLM Analysis failed: {e}")
+            return self._failure_report()
+
+        return self._repair_report(content, finish_reason, messages, model_id, cancel_token)
+
+    @staticmethod
+    def _exceeds_limit(message: str) -> bool:
+        # "... tokens per minute (TPM): Limit 6000, Used 0, Requested 9000": too big for any wait
+        match = re.search(r"Limit (\d+).*?Requested (\d+)", message)
+        return bool(match) and int(match.group(2)) > int(match.group(1))
+
+    @staticmethod
+    def _retry_after(error) -> float:
+        response = getattr(error, "response", None)
+        header = response.headers.get("retry-after") if response is not None else None
         try:
-            chat_completion = self.client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
+            return float(header)
+        except (TypeError, ValueError):
+            match = re.search(r"try again in (?:(\d+)m)?([\d.]+)s", str(error))
+            return int(match.group(1) or 0) * 60 + float(match.group(2)) if match else None
+
+    def _complete(self, messages: list, model_id: str, cancel_token: CancelToken = None) -> tuple:
+        """
+        One chat completion in JSON mode. Returns (content, finish_reason, prompt tokens reported or None).
+        """
+        unregister = None
+        try:
+            create = lambda: self.client.chat.completions.create(
+                messages=messages,
                 model=model_id,
                 temperature=0.2, # Low temperature to ensure valid JSON structure
-                max_tokens=6000, # Increased max_tokens to allow for longer, detailed reports
+                max_tokens=self.MAX_TOKENS, # Increased max_tokens to allow for longer, detailed reports
                 response_format={"type": "json_object"}
             )
-            
-            return chat_completion.choices[0].message.content
+            if cancel_token is not None:
+                # Closing the client aborts the in-flight request instead of letting it run to completion
+                unregister = cancel_token.add_callback(self.client.close)
+                chat_completion = cancel_token.call(create)
+            else:
+                chat_completion = create()
 
-        except Exception as e:
-            logger.error(f"LLM Analysis failed: {e}")
-            return json.dumps({
-                "executive_summary": "Analysis failed or timed out.",
-                "key_strengths": [], "critical_issues": ["Error"], "quality_score": 0,
-                "code_smells": [], "technical_debt": [], "refactoring_suggestions": [],
-                "security_analysis": "N/A"
-            })
+            prompt_tokens = chat_completion.usage.prompt_tokens if chat_completion.usage is not None else None
+            choice = chat_completion.choices[0]
+            return choice.message.content, getattr(choice, "finish_reason", None), prompt_tokens
+        finally:
+            if unregister is not None:
+                unregister()
+
+    def _repair_report(self, content: str, finish_reason: str, messages: list, model_id: str,
+                       cancel_token: CancelToken = None) -> str:
+        """
+        Complete output is returned as is. Output cut off at max_tokens (or never closed)
+        is repaired: complete sections are kept, and one continuation call asks for the
+        missing sections only, instead of the caller re-running the whole pipeline.
+        Sections still missing after that are listed in incomplete_sections.
+        """
+        salvaged = salvage_report(content, AnalysisReport, self.REPORT_SECTIONS)
+        if not salvaged.truncated and finish_reason != "length":
+            return content
+
+        sections, missing = dict(salvaged.sections), salvaged.missing
+        logger.warning(
+            f"LLM report for {model_id} was cut off ({finish_reason}); "
+            f"salvaged {len(sections)} sections, missing: {missing}"
+        )
+
+        if missing:
+            partial = AnalysisReport(**sections).model_dump(include=set(sections))
+            continuation = messages + [
+                {"role": "assistant", "content": json.dumps(partial)},
+                {"role": "user", "content": (
+                    "Your previous answer was cut off. Do NOT repeat the sections above. "
+                    f"Return ONLY a JSON object with exactly these keys: {', '.join(missing)}. "
+                    "Keep it concise so it fits."
+                )},
+            ]
+            try:
+                extra, _, _ = self._complete(continuation, model_id, cancel_token)
+                more = salvage_report(extra, AnalysisReport, missing)
+                sections.update(more.sections)
+                missing = more.missing
+            except AnalysisCancelledError:
+                raise
+            except Exception as e:
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+                # The salvaged sections are still worth returning
+                logger.warning(f"Continuation for missing report sections failed: {e}")
+
+        return AnalysisReport(**sections, incomplete_sections=missing).model_dump_json()
+
+    def _failure_report(self) -> str:
+        return json.dumps({
+            "executive_summary": "Analysis failed or timed out.",
+            "key_strengths": [], "critical_issues": ["Error"], "quality_score": 0,
+            "code_smells": [], "technical_debt": [], "refactoring_suggestions": [],
+            "security_analysis": "N/A"
+        })
@@ -0,0 +1,249 @@
+import ast
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import tokenize
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List
+
+from app.core.settings import settings
+from app.services.cancellation import CancelToken
+
+logger = logging.getLogger(__name__)
+
+# Directories never worth analyzing (same idea as GitHubService.IGNORED_DIRS)
+IGNORED_DIRS = {'.git', 'node_modules', 'venv', '.venv', '__pycache__', 'dist', 'build', '.next', '.idea', '.vscode', '.tox', '.eggs'}
+
+
+class SkeletonVisitor(ast.NodeTransformer):
+    """
+    Replaces function bodies with their docstring and `...`, keeping signatures and classes.
+    """
+
+    def visit_FunctionDef(self, node):
+        # Keep docstring
+        docstring = ast.get_docstring(node)
+        new_body = []
+        if docstring:
+            new_body.append(ast.Expr(value=ast.Constant(value=docstring)))
+        new_body.append(ast.Expr(value=ast.Constant(value="...")))
+        node.body = new_body
+        return node
+
+    def visit_AsyncFunctionDef(self, node):
+        return self.visit_FunctionDef(node)
+
+    def visit_ClassDef(self, node):
+        # Process methods inside class
+        self.generic_visit(node)
+        return node
+
+
+def extract_import_records(tree: ast.AST) -> List[tuple]:
+    """
+    Returns (level, module, [names]) for every import in the tree.
+    `import a.b` is recorded as (0, None, ["a.b"]).
+    """
+    records = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            records.append((0, None, [alias.name for alias in node.names]))
+        elif isinstance(node, ast.ImportFrom):
+            records.append((node.level or 0, node.module, [alias.name for alias in node.names]))
+    return records
+
+
+# --- Worker side (runs inside the process pool) ---
+
+_bandit = None
+
+
+def _get_bandit():
+    """
+    Loads bandit's plugin set once per worker process.
+    """
+    global _bandit
+    if _bandit is None:
+        from bandit.core import config as b_config
+        from bandit.core import meta_ast as b_meta_ast
+        from bandit.core import test_set as b_test_set
+        _bandit = (b_meta_ast.BanditMetaAst(), b_test_set.BanditTestSet(b_config.BanditConfig()))
+    return _bandit
+
+
+def _nosec_lines(data: bytes) -> Dict[int, Any]:
+    from bandit.core.manager import _parse_nosec_comment
+    nosec_lines = {}
+    try:
+        for toktype, tokval, (lineno, _), _, _ in tokenize.tokenize(io.BytesIO(data).readline):
+            if toktype == tokenize.COMMENT:
+                nosec_lines[lineno] = _parse_nosec_comment(tokval)
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    return nosec_lines
+
+
+def _security_issues(tree: ast.AST, path: str, data: bytes) -> List[dict]:
+    from bandit.core import metrics as b_metrics
+    from bandit.core import node_visitor as b_node_visitor
+
+    meta_ast, test_set = _get_bandit()
+    metrics = b_metrics.Metrics()
+    metrics.begin(path)
+    visitor = b_node_visitor.BanditNodeVisitor(
+        path, io.BytesIO(data), meta_ast, test_set, False, _nosec_lines(data), metrics
+    )
+    # Same as BanditNodeVisitor.process(), minus its own ast.parse
+    visitor.generic_visit(tree)
+    return [issue.as_dict() for issue in visitor.tester.results]
+
+
+def _complexity_blocks(tree: ast.AST) -> List[dict]:
+    from radon.cli.tools import cc_to_dict
+    from radon.complexity import cc_visit_ast
+    return [cc_to_dict(block) for block in cc_visit_ast(tree)]
+
+
+def analyze_python_file(path: str) -> Dict[str, Any]:
+    """
+    Reads and parses one Python file once, and runs every per-file pass on that tree:
+    security checks (bandit plugins), complexity (radon), imports, and finally the
+    skeleton (last, because it rewrites function bodies in place).
+    """
+    result = {"path": path, "blocks": [], "issues": [], "imports": [], "skeleton": None, "error": None}
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        tree = ast.parse(data, filename=path)
+    except Exception as e:
+        # Besides SyntaxError/OSError: deeply nested generated code raises RecursionError
+        # (or MemoryError); record it for this file instead of failing the whole chunk
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+
+    for key, run in (
+        ("issues", lambda: _security_issues(tree, path, data)),
+        ("blocks", lambda: _complexity_blocks(tree)),
+        ("imports", lambda: extract_import_records(tree)),
+    ):
+        try:
+            result[key] = run()
+        except Exception as e:
+            logger.error(f"{key} pass failed for {path}: {e}")
+
+    try:
+        result["skeleton"] = ast.unparse(SkeletonVisitor().visit(tree))
+    except Exception as e:
+        logger.error(f"Skeleton pass failed for {path}: {e}")
+    return result
+
+
+def analyze_python_files(paths: List[str]) -> List[Dict[str, Any]]:
+    return [analyze_python_file(path) for path in paths]
+
+
+def warm_worker(_: int) -> int:
+    """
+    Loads radon and bandit's plugins in a worker ahead of the first analysis.
+    """
+    _get_bandit()
+    from radon.complexity import cc_visit_ast  # noqa: F401
+    return os.getpid()
+
+
+# --- Parent side ---
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Each worker holds bandit and radon in memory; more than a few rarely pays off
+DEFAULT_MAX_WORKERS = 4
+
+
+def _worker_count() -> int:
+    if settings.analysis_workers:
+        return settings.analysis_workers
+    try:
+        # CPUs this process may run on; os.cpu_count() reports the host's inside a container
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = os.cpu_count() or 1
+    return max(1, min(available, DEFAULT_MAX_WORKERS))
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a multi-threaded server process is not safe
+            _pool = ProcessPoolExecutor(
+                max_workers=_worker_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def warm_pool() -> int:
+    """
+    Starts every pool worker and preloads its imports. Returns the number of workers started.
+    """
+    return len(set(_get_pool().map(warm_worker, range(_worker_count()))))
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+class PythonAnalysisService:
+    """
+    Runs analyze_python_file over a repository's Python files on a shared process pool.
+    The results (keyed by absolute path) feed GitHubService (skeletons, imports) and
+    StaticAnalysisService (complexity, security), so no file is parsed twice and no
+    radon/bandit subprocesses are launched.
+    """
+
+    def analyze_repository(self, repo_path: str, cancel_token: CancelToken = None) -> Dict[str, Dict[str, Any]]:
+        paths = []
+        for root, dirs, files in os.walk(repo_path):
+            dirs[:] = [d for d in dirs if d not in IGNORED_DIRS]
+            paths.extend(os.path.join(root, name) for name in files if name.endswith('.py'))
+        return self.analyze_files(paths, cancel_token=cancel_token)
+
+    def analyze_files(self, paths: List[str], cancel_token: CancelToken = None) -> Dict[str, Dict[str, Any]]:
+        """
+        If cancel_token is cancelled, chunks that have not started are dropped and the
+        cancellation is raised; chunks already running finish in the background.
+        """
+        if not paths:
+            return {}
+        logger.info(f"Running shared Python analysis pass on {len(paths)} files")
+        chunksize = max(1, len(paths) // (_worker_count() * 4))
+        chunks = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+        try:
+            results = self._run_chunks(chunks, cancel_token)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM); start a fresh pool and retry once
+            _reset_pool()
+            results = self._run_chunks(chunks, cancel_token)
+        return {os.path.normpath(result["path"]): result for result in results}
+
+    def _run_chunks(self, chunks: List[List[str]], cancel_token: CancelToken = None) -> List[Dict[str, Any]]:
+        pool = _get_pool()
+        futures = [pool.submit(analyze_python_files, chunk) for chunk in chunks]
+        try:
+            pending = set(futures)
+            while pending:
+                _, pending = wait(pending, timeout=CancelToken.POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+            return [result for future in futures for result in future.result()]
+        finally:
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,208 @@
+import json
+import logging
+from typing import Any, Dict, List, Optional, Set, Type
+
+from pydantic import BaseModel, ValidationError
+
+logger = logging.getLogger(__name__)
+
+
+class JsonRepairer:
+    """
+    Incremental, tolerant JSON scanner for LLM output. Text can be fed in chunks (as it
+    streams in, or all at once); parse() returns the last complete prefix of the first
+    top-level object with every open array/object closed, so output cut off at
+    max_tokens still yields everything up to the last complete value.
+
+    Also tolerates prose or code fences around the object, trailing commas and raw
+    control characters inside strings.
+    """
+
+    def __init__(self):
+        self._out: List[str] = []          # repaired text so far
+        self._stack: List[str] = []        # open containers: '{' or '['
+        self._expect_key: List[bool] = []  # per open object: is the next string a key?
+        self._in_string = False
+        self._escaped = False
+        self._string_is_key = False
+        self._in_literal = False           # inside a number / true / false / null
+        self._started = False
+        self._done = False
+        # Last point at which the text can be cut and closed into valid JSON
+        self._safe_length = 0
+        self._safe_stack: List[str] = []
+        # Top-level keys: the one being written and the ones whose value is complete
+        self._top_key_chars: List[str] = []
+        self._top_key: Optional[str] = None
+        self.completed_keys: Set[str] = set()
+
+    @property
+    def complete(self) -> bool:
+        return self._done
+
+    def feed(self, chunk: str):
+        for char in chunk:
+            if self._done:
+                return
+            self._feed_char(char)
+
+    def _mark_safe(self):
+        # Inside a list item the cut would keep a half-written object (e.g. a code smell
+        # without its suggestion); only whole items and sections count
+        if len(self._stack) > 2:
+            return
+        self._safe_length = len(self._out)
+        self._safe_stack = list(self._stack)
+        if len(self._stack) == 1 and self._top_key is not None:
+            self.completed_keys.add(self._top_key)
+
+    def _feed_char(self, char: str):
+        if not self._started:
+            # Skip prose / ```json fences before the object
+            if char != "{":
+                return
+            self._started = True
+
+        if self._in_string:
+            self._out.append(char)
+            if self._string_is_key and len(self._stack) == 1:
+                self._top_key_chars.append(char)
+            if self._escaped:
+                self._escaped = False
+            elif char == "\\":
+                self._escaped = True
+            elif char == '"':
+                self._in_string = False
+                if self._string_is_key:
+                    if len(self._stack) == 1:
+                        self._top_key = json.loads('"' + "".join(self._top_key_chars), strict=False)
+                else:
+                    self._mark_safe()
+            return
+
+        if self._in_literal:
+            if char.isalnum() or char in "+-.":
+                self._out.append(char)
+                return
+            # The delimiter proves the literal is complete
+            self._in_literal = False
+            self._mark_safe()
+
+        if char.isspace():
+            self._out.append(char)
+        elif char == '"':
+            self._in_string = True
+            self._string_is_key = bool(self._stack) and self._stack[-1] == "{" and self._expect_key[-1]
+            if self._string_is_key and len(self._stack) == 1:
+                self._top_key_chars = []
+            self._out.append(char)
+        elif char in "{[":
+            self._stack.append(char)
+            if char == "{":
+                self._expect_key.append(True)
+            self._out.append(char)
+            if len(self._stack) == 1:
+                # Only the outer object: an empty nested one would pass as a default-filled item
+                self._mark_safe()
+        elif char in "}]":
+            if not self._stack:
+                return
+            self._drop_trailing_comma()
+            opener = self._stack.pop()
+            if opener == "{":
+                self._expect_key.pop()
+            self._out.append("}" if opener == "{" else "]")
+            if not self._stack:
+                self._done = True
+            self._mark_safe()
+        elif char == ":":
+            if self._stack and self._stack[-1] == "{":
+                self._expect_key[-1] = False
+            self._out.append(char)
+        elif char == ",":
+            if self._stack and self._stack[-1] == "{":
+                self._expect_key[-1] = True
+            self._out.append(char)
+        else:
+            self._in_literal = True
+            self._out.append(char)
+
+    def _drop_trailing_comma(self):
+        index = len(self._out) - 1
+        while index >= 0 and self._out[index].isspace():
+            index -= 1
+        if index >= 0 and self._out[index] == ",":
+            del self._out[index]
+
+    def parse(self) -> Optional[Any]:
+        """
+        The repaired value, or None if not even a partial object could be recovered.
+        """
+        if not self._started:
+            return None
+        if self._done:
+            text = "".join(self._out)
+        else:
+            # Safe points sit right after a complete value, so no dangling key or comma to strip
+            text = "".join(self._out[:self._safe_length])
+            text += "".join("}" if opener == "{" else "]" for opener in reversed(self._safe_stack))
+        try:
+            return json.loads(text, strict=False)
+        except ValueError as e:
+            logger.warning(f"Could not repair LLM JSON output: {e}")
+            return None
+
+
+class SalvagedReport:
+    def __init__(self, sections: Dict[str, Any], missing: List[str], truncated: bool):
+        self.sections = sections  # validated sections, keyed by field name
+        self.missing = missing    # fields that are absent, cut off or failed validation
+        self.truncated = truncated
+
+
+def salvage_report(raw_report: str, schema: Type[BaseModel], sections: Optional[List[str]] = None) -> SalvagedReport:
+    """
+    Repairs the raw LLM output and validates it section by section against schema, so
+    one bad section does not cost the others. List sections keep their valid items;
+    a section that was cut off counts as missing unless some of its items survived.
+    sections limits which fields are expected (default: all fields of schema).
+    """
+    expected = sections if sections is not None else list(schema.model_fields)
+    repairer = JsonRepairer()
+    repairer.feed(raw_report or "")
+    data = repairer.parse()
+    if not isinstance(data, dict):
+        return SalvagedReport({}, list(expected), truncated=not repairer.complete)
+
+    salvaged, missing = {}, []
+    for name in expected:
+        field = schema.model_fields[name]
+        if name not in data:
+            missing.append(name)
+            continue
+        value = data[name]
+        cut_off = name not in repairer.completed_keys
+
+        if isinstance(value, list) and getattr(field.annotation, "__origin__", None) is list:
+            # Validate items one by one; drop the broken ones
+            items = []
+            for item in value:
+                try:
+                    items.append(getattr(schema.model_validate({name: [item]}), name)[0])
+                except ValidationError:
+                    continue
+            if cut_off and not items:
+                missing.append(name)
+            else:
+                salvaged[name] = items
+            continue
+
+        if cut_off:
+            missing.append(name)
+            continue
+        try:
+            salvaged[name] = getattr(schema.model_validate({name: value}), name)
+        except ValidationError:
+            missing.append(name)
+
+    return SalvagedReport(salvaged, missing, truncated=not repairer.complete)
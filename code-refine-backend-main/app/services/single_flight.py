@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from starlette.requests import Request
+
+from app.core.settings import settings
+from app.services.cancellation import AnalysisCancelledError, CancelToken
+
+logger = logging.getLogger(__name__)
+
+
+class FlightCapacityError(Exception):
+    pass
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task, cancel_token: CancelToken):
+        self.task = task
+        self.cancel_token = cancel_token
+        self.followers = 0
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical work: the first caller for a key (the leader)
+    starts it, and callers arriving with the same key while it runs (followers)
+    await the same result or exception instead of starting their own.
+
+    The work runs detached from the leader's request, so it survives the leader
+    disconnecting as long as someone is still waiting; once every waiter is gone
+    its cancel token is cancelled. Results are shared between callers and must
+    not be mutated.
+    """
+
+    def __init__(self, max_followers: int, poll_interval: float = 1.0):
+        self.max_followers = max_followers
+        self.poll_interval = poll_interval
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    async def run(self, key: Hashable, work: Callable[[], Awaitable[Any]], cancel_token: CancelToken,
+                  request: Optional[Request] = None) -> Any:
+        """
+        Returns the result of work() for key, sharing it with concurrent callers.
+        cancel_token is the token work() runs under; it is only used if this caller leads.
+        Raises FlightCapacityError if the running flight already has max_followers.
+        """
+        flight = self._flights.get(key)
+        follower = flight is not None
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(work()), cancel_token)
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._finish(key, flight))
+        else:
+            if flight.followers >= self.max_followers:
+                raise FlightCapacityError(f"Too many requests are already waiting for this analysis (max {self.max_followers}).")
+            flight.followers += 1
+            logger.info(f"Joined in-flight analysis as follower {flight.followers}: {key}")
+
+        flight.waiters += 1
+        try:
+            return await self._wait(flight, request)
+        finally:
+            flight.waiters -= 1
+            if follower:
+                # Only followers still waiting count towards the cap
+                flight.followers -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.cancel_token.cancel("all clients disconnected")
+                # A new request must start fresh instead of joining the cancelled run
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    async def _wait(self, flight: _Flight, request: Optional[Request]) -> Any:
+        if request is None:
+            # asyncio.wait never cancels the shared task, unlike awaiting it directly
+            await asyncio.wait({flight.task})
+            return flight.task.result()
+
+        while True:
+            done, _ = await asyncio.wait({flight.task}, timeout=self.poll_interval)
+            if done:
+                return flight.task.result()
+            if await request.is_disconnected():
+                raise AnalysisCancelledError("client disconnected")
+
+    def _finish(self, key: Hashable, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.task.cancelled():
+            # Mark the exception as retrieved even if every waiter already left
+            flight.task.exception()
+
+
+analysis_flights = SingleFlight(
+    max_followers=settings.coalesce_max_followers,
+    poll_interval=settings.disconnect_poll_seconds,
+)
@@ -2,27 +2,171 @@ import os
 import json
 import subprocess
 import logging
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
+from app.services.cancellation import AnalysisCancelledError, CancelToken
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class StaticAnalysisService:
-    def analyze_repository(self, repo_path: str) -> Dict[str, Any]:
+    def analyze_repository(self, repo_path: str,
+                           python_analyses: Optional[Dict[str, Dict[str, Any]]] = None,
+                           cancel_token: Optional[CancelToken] = None) -> Dict[str, Any]:
         """
         Runs static analysis (complexity and security) on the given repository path.
+        With python_analyses (from PythonAnalysisService) the results are aggregated
+        from the shared single-parse pass instead of running radon/bandit subprocesses.
+        Cancelling cancel_token kills the radon/bandit subprocesses.
         """
         logger.info(f"Starting static analysis for: {repo_path}")
-        
-        complexity_data = self._analyze_complexity(repo_path)
-        security_data = self._analyze_security(repo_path)
+
+        if python_analyses is not None:
+            return self._summarize_analyses(python_analyses)
+
+        complexity_data = self._analyze_complexity(repo_path, cancel_token=cancel_token)
+        security_data = self._analyze_security(repo_path, cancel_token=cancel_token)
         
         return {
             "complexity": complexity_data,
             "security": security_data
         }
 
-    def _analyze_complexity(self, repo_path: str) -> Dict[str, Any]:
+    def analyze_changes(self, repo_path: str, changed_lines: Dict[str, List[Tuple[int, int]]],
+                        python_analyses: Optional[Dict[str, Dict[str, Any]]] = None,
+                        cancel_token: Optional[CancelToken] = None) -> Dict[str, Any]:
+        """
+        Runs static analysis only on the changed Python files and keeps only
+        the findings that overlap the changed line ranges.
+        """
+        line_filter = {
+            os.path.normpath(os.path.join(repo_path, rel_path)): ranges
+            for rel_path, ranges in changed_lines.items()
+            if rel_path.endswith(".py") and os.path.isfile(os.path.join(repo_path, rel_path))
+        }
+        logger.info(f"Starting static analysis for {len(line_filter)} changed files in: {repo_path}")
+
+        if not line_filter:
+            return {
+                "complexity": {"average_score": "A", "average_value": 0.0},
+                "security": {"score": 100, "issues": []}
+            }
+
+        if python_analyses is not None:
+            return self._summarize_analyses(python_analyses, line_filter)
+
+        targets = list(line_filter)
+        return {
+            "complexity": self._analyze_complexity(repo_path, targets=targets, line_filter=line_filter,
+                                                   cancel_token=cancel_token),
+            "security": self._analyze_security(repo_path, targets=targets, line_filter=line_filter,
+                                               cancel_token=cancel_token)
+        }
+
+    def _summarize_analyses(self, python_analyses: Dict[str, Dict[str, Any]],
+                            line_filter: Optional[Dict[str, List[Tuple[int, int]]]] = None) -> Dict[str, Any]:
+        complexity_data = {path: analysis["blocks"] for path, analysis in python_analyses.items()}
+        security_results = [issue for analysis in python_analyses.values() for issue in analysis["issues"]]
+        return {
+            "complexity": self._summarize_complexity(complexity_data, line_filter),
+            "security": self._summarize_security(security_results, line_filter)
+        }
+
+    def _in_ranges(self, start: int, end: int, ranges: List[Tuple[int, int]]) -> bool:
+        return any(start <= range_end and end >= range_start for range_start, range_end in ranges)
+
+    def _summarize_complexity(self, data: Dict[str, Any],
+                              line_filter: Optional[Dict[str, List[Tuple[int, int]]]] = None) -> Dict[str, Any]:
+        """
+        Averages radon blocks ({filename: [block, ...]}) into a letter score.
+        """
+        total_complexity = 0
+        count = 0
+
+        for filename, blocks in data.items():
+            if not isinstance(blocks, list):
+                continue  # radon reports per-file errors as {"error": ...}
+            for block in blocks:
+                if line_filter is not None:
+                    start = block.get('lineno', 0)
+                    end = block.get('endline', start)
+                    if not self._in_ranges(start, end, line_filter.get(os.path.normpath(filename), [])):
+                        continue
+                if 'complexity' in block:
+                    total_complexity += block['complexity']
+                    count += 1
+
+        if count == 0:
+            return {"average_score": "A", "average_value": 0.0}
+
+        avg_value = total_complexity / count
+
+        # Map to Score
+        if avg_value <= 5:
+            score = "A"
+        elif avg_value <= 10:
+            score = "B"
+        elif avg_value <= 20:
+            score = "C"
+        elif avg_value <= 40:
+            score = "D"
+        else:
+            score = "F"
+
+        return {
+            "average_score": score,
+            "average_value": round(avg_value, 2)
+        }
+
+    def _summarize_security(self, results: List[Dict[str, Any]],
+                            line_filter: Optional[Dict[str, List[Tuple[int, int]]]] = None) -> Dict[str, Any]:
+        """
+        Scores bandit results and trims them to the fields the report needs.
+        """
+        # Calculate score
+        # Logic: Start 100, -10 High, -5 Medium, -2 Low
+        score = 100
+        issues_list = []
+
+        for issue in results:
+            if line_filter is not None:
+                line_range = issue.get('line_range') or [issue.get('line_number', 0)]
+                if not self._in_ranges(min(line_range), max(line_range), line_filter.get(os.path.normpath(issue.get('filename', '')), [])):
+                    continue
+
+            severity = issue.get('issue_severity', 'LOW')
+
+            # Include everything in the list but deduct score based on Severity
+            if severity == 'HIGH':
+                score -= 10
+            elif severity == 'MEDIUM':
+                score -= 5
+            elif severity == 'LOW':
+                score -= 2
+
+            # Collect issue details
+            issues_list.append({
+                "filename": issue.get('filename'),
+                "issue_text": issue.get('issue_text'),
+                "severity": severity,
+                "line_number": issue.get('line_number'),
+                "code": issue.get('code', '').strip()
+            })
+
+        score = max(0, score) # Min 0
+
+        return {
+            "score": score,
+            "issues": issues_list
+        }
+
+    def _run_tool(self, command: List[str], cancel_token: Optional[CancelToken] = None) -> subprocess.CompletedProcess:
+        if cancel_token is not None:
+            return cancel_token.run_process(command, text=True)
+        return subprocess.run(command, capture_output=True, text=True, check=False)
+
+    def _analyze_complexity(self, repo_path: str, targets: Optional[List[str]] = None,
+                            line_filter: Optional[Dict[str, List[Tuple[int, int]]]] = None,
+                            cancel_token: Optional[CancelToken] = None) -> Dict[str, Any]:
         """
         Calculates average Cyclomatic Complexity using radon.
         """
@@ -35,12 +179,7 @@ class StaticAnalysisService:
             # Let's use 'radon cc . -a -j'
             
             # Since radon might analyze many files, let's use the CLI for JSON output
-            result = subprocess.run(
-                ["radon", "cc", repo_path, "-a", "-j"],
-                capture_output=True,
-                text=True,
-                check=False
-            )
+            result = self._run_tool(["radon", "cc", *(targets or [repo_path]), "-a", "-j"], cancel_token)
             
             if result.returncode != 0:
                 logger.error(f"Radon failed: {result.stderr}")
@@ -53,54 +192,25 @@ class StaticAnalysisService:
             # Safe bet: iterate all blocks and calculate average ourselves.
             
             data = json.loads(result.stdout)
-            total_complexity = 0
-            count = 0
-            
-            for filename, blocks in data.items():
-                for block in blocks:
-                    if 'complexity' in block:
-                        total_complexity += block['complexity']
-                        count += 1
-            
-            if count == 0:
-                return {"average_score": "A", "average_value": 0.0}
-            
-            avg_value = total_complexity / count
-            
-            # Map to Score
-            if avg_value <= 5:
-                score = "A"
-            elif avg_value <= 10:
-                score = "B"
-            elif avg_value <= 20:
-                score = "C"
-            elif avg_value <= 40:
-                score = "D"
-            else:
-                score = "F"
-                
-            return {
-                "average_score": score,
-                "average_value": round(avg_value, 2)
-            }
+            return self._summarize_complexity(data, line_filter)
 
+        except AnalysisCancelledError:
+            raise
         except Exception as e:
             logger.error(f"Error in complexity analysis: {e}")
             return {"average_score": "Error", "average_value": 0.0}
 
-    def _analyze_security(self, repo_path: str) -> Dict[str, Any]:
+    def _analyze_security(self, repo_path: str, targets: Optional[List[str]] = None,
+                          line_filter: Optional[Dict[str, List[Tuple[int, int]]]] = None,
+                          cancel_token: Optional[CancelToken] = None) -> Dict[str, Any]:
         """
         Runs bandit for security analysis.
         """
         try:
             # Run bandit recursively
             # -r: recursive, -f json: json format
-            result = subprocess.run(
-                ["bandit", "-r", repo_path, "-f", "json"],
-                capture_output=True,
-                text=True,
-                check=False # Bandit returns exit code 1 if issues found
-            )
+            # Bandit returns exit code 1 if issues found
+            result = self._run_tool(["bandit", "-r", *(targets or [repo_path]), "-f", "json"], cancel_token)
             
             # Bandit writes to stdout usually, but if it fails strictly it might be stderr.
             # Even if exit code is 1, stdout usually has the json report.
@@ -119,43 +229,10 @@ class StaticAnalysisService:
                 logger.error(f"Failed to parse bandit output: {output[:200]}...")
                 return {"score": 100, "issues": []}
 
-            # Calculate score
-            # Logic: Start 100, -10 High, -5 Medium
-            score = 100
-            issues_list = []
-            
-            results = data.get('results', [])
-            
-            for issue in results:
-                severity = issue.get('issue_severity', 'LOW')
-                confidence = issue.get('issue_confidence', 'LOW')
-                
-                # Filter for High/Medium severity or High Confidence?
-                # Let's include everything in the list but deduct score based on Severity
-                
-                if severity == 'HIGH':
-                    score -= 10
-                elif severity == 'MEDIUM':
-                    score -= 5
-                elif severity == 'LOW':
-                    score -= 2
-                
-                # Collect issue details
-                issues_list.append({
-                    "filename": issue.get('filename'),
-                    "issue_text": issue.get('issue_text'),
-                    "severity": severity,
-                    "line_number": issue.get('line_number'),
-                    "code": issue.get('code', '').strip()
-                })
-
-            score = max(0, score) # Min 0
-            
-            return {
-                "score": score,
-                "issues": issues_list
-            }
+            return self._summarize_security(data.get('results', []), line_filter)
 
+        except AnalysisCancelledError:
+            raise
         except Exception as e:
             logger.error(f"Error in security analysis: {e}")
             return {"score": 0, "issues": [{"error": str(e)}]}
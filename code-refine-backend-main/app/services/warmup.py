@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+
+def _import_groq():
+    import groq  # noqa: F401
+
+
+def _load_tokenizer():
+    from app.services.github_service import get_tokenizer
+    if get_tokenizer() is None:
+        raise RuntimeError("cl100k_base could not be loaded; token counts are approximated")
+
+
+def _start_analysis_workers():
+    from app.services.python_analysis import warm_pool
+    warm_pool()
+
+
+class WarmupService:
+    """
+    Pays the one-off costs of the first analysis (heavy imports, the tokenizer,
+    the analysis worker processes) in a background thread after startup, so the
+    server accepts connections immediately and the readiness probe tells the
+    load balancer when a replica is actually useful.
+    """
+
+    STEPS = [
+        ("groq", _import_groq),
+        ("tokenizer", _load_tokenizer),
+        ("analysis_workers", _start_analysis_workers),
+    ]
+
+    def __init__(self):
+        self.ready = False
+        self.timings_ms: Dict[str, int] = {}
+        self.errors: Dict[str, str] = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        self.timings_ms[name] = int(seconds * 1000)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+            self._thread.start()
+
+    def mark_ready(self):
+        self.ready = True
+
+    def _run(self):
+        started = time.perf_counter()
+        for name, step in self.STEPS:
+            step_started = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                # Degraded but usable (e.g. approximate token counts); report it, don't block readiness
+                logger.warning(f"Warm-up step {name} failed: {e}")
+                self.errors[name] = str(e)
+            self.record(name, time.perf_counter() - step_started)
+        self.record("warmup_total", time.perf_counter() - started)
+        self.mark_ready()
+        logger.info(f"Warm-up finished: {self.timings_ms}")
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "status": "ready" if self.ready else "warming_up",
+            "timings_ms": dict(self.timings_ms),
+            "errors": dict(self.errors),
+        }
+
+
+warmup = WarmupService()
@@ -0,0 +1,516 @@
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from app.core.settings import settings
+from app.services.cancellation import AnalysisCancelledError, CancelToken
+
+logger = logging.getLogger(__name__)
+
+
+class WorkspaceError(Exception):
+    pass
+
+
+_SHA_PATTERN = re.compile(r"^[0-9a-fA-F]{4,64}$")
+# scp-like remote, e.g. git@github.com:owner/repo
+_SCP_URL_PATTERN = re.compile(r"^([^/:]+):(.*)$")
+# Hosts whose repository paths ignore letter case
+CASE_INSENSITIVE_HOSTS = {"github.com"}
+
+
+def validate_ref(ref: str) -> str:
+    """
+    Accepts a commit SHA or a well-formed branch/tag name and raises ValueError otherwise.
+    Refs end up on git command lines, so anything starting with '-' (an option such as
+    --output=<file>) is rejected outright.
+    """
+    if not ref or ref.startswith("-"):
+        raise ValueError("Invalid git ref.")
+    if _SHA_PATTERN.match(ref):
+        return ref
+    result = subprocess.run(["git", "check-ref-format", "--allow-onelevel", ref], capture_output=True)
+    if result.returncode != 0:
+        raise ValueError(f"Invalid git ref: {ref!r}")
+    return ref
+
+
+def normalize_repo_url(repo_url: str) -> str:
+    """
+    Returns the canonical spelling of a repository URL: no trailing slash or '.git',
+    lowercase scheme and host. The path keeps its case except on CASE_INSENSITIVE_HOSTS,
+    because elsewhere `Repo` and `repo` may be two different repositories.
+    """
+    url = repo_url.strip().rstrip("/")
+    if url.endswith(".git"):
+        url = url[:-4]
+
+    if "://" in url:
+        parts = urlsplit(url)
+        userinfo, at, host = parts.netloc.rpartition("@")
+        host = host.lower()
+        path = parts.path.lower() if parts.hostname in CASE_INSENSITIVE_HOSTS else parts.path
+        return urlunsplit((parts.scheme.lower(), f"{userinfo}{at}{host}", path, parts.query, parts.fragment))
+
+    match = _SCP_URL_PATTERN.match(url)
+    if match:
+        userinfo, at, host = match.group(1).rpartition("@")
+        host = host.lower()
+        path = match.group(2).lower() if host in CASE_INSENSITIVE_HOSTS else match.group(2)
+        return f"{userinfo}{at}{host}:{path}"
+    return url  # local path
+
+
+class WorkspaceManager:
+    """
+    Hands out isolated, cheap checkouts for analysis jobs.
+
+    Every remote repository is mirrored once into a shared bare object store
+    (<root>/mirrors). Each job then gets its own detached `git worktree` under
+    <root>/jobs, so concurrent jobs never touch each other's files and no
+    objects are downloaded or copied twice. A global disk quota is enforced by
+    evicting the least recently used mirrors that no job is currently using.
+
+    Several processes (uvicorn workers) may share the root:
+    - each one keeps its jobs under <root>/jobs/<owner> and holds an flock on
+      <owner>.lock for as long as it lives, so sweep_stale_jobs() only removes
+      directories of dead processes;
+    - git operations on a mirror (clone, fetch, worktree add/remove, eviction) hold
+      an flock on <mirror>.lock besides the in-process lock;
+    - a mirror is only evicted when no worktree is registered in it, whichever
+      process created that worktree;
+    - mirror and job sizes are kept in <path>.size files, so the quota counts the
+      usage of every process.
+    """
+
+    def __init__(self, root_dir: str, quota_bytes: int, fetch_interval: int = 30):
+        self.root_dir = root_dir
+        self.mirrors_dir = os.path.join(root_dir, "mirrors")
+        self.jobs_dir = os.path.join(root_dir, "jobs")
+        self.quota_bytes = quota_bytes
+        self.fetch_interval = fetch_interval
+
+        self._lock = threading.Lock()  # guards the bookkeeping below
+        self._mirror_locks = {}        # mirror path -> lock serializing this process's git ops on it
+        self._active = {}              # mirror path -> number of this process's jobs using it
+        self._fetched_at = {}          # mirror path -> last successful fetch (monotonic)
+        self._jobs = {}                # job dir -> {"mirror", "busy", "released", "commit"}
+
+        # Created on first use, so merely importing the app touches nothing on disk
+        self._owner_dir = None
+        self._owner_lock_file = None
+
+    # --- Public API ---
+
+    def sweep_stale_jobs(self):
+        """
+        Removes job directories left behind by processes that are gone (crash, restart).
+        Directories of live processes sharing the root are left alone.
+        """
+        if not os.path.isdir(self.jobs_dir):
+            return
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith(".lock"):
+                continue
+            lock_path = os.path.join(self.jobs_dir, name)
+            owner_dir = lock_path[:-len(".lock")]
+            if owner_dir == self._owner_dir:
+                continue
+            with open(lock_path, "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # the owner is alive
+                shutil.rmtree(owner_dir, ignore_errors=True)
+                os.remove(lock_path)
+                logger.info(f"Removed stale job directory {owner_dir}")
+
+    def reserve(self) -> str:
+        """
+        Reserves a unique job directory without creating it.
+        Lets a caller release the job even if it is cancelled mid-checkout.
+        """
+        job_dir = os.path.join(self._ensure_owner_dir(), uuid.uuid4().hex)
+        with self._lock:
+            self._jobs[job_dir] = {"mirror": None, "busy": False, "released": False, "commit": None}
+        return job_dir
+
+    def allocate(self) -> str:
+        """
+        Creates an empty job directory for sources that are not git remotes.
+        """
+        job_dir = self.reserve()
+        os.makedirs(job_dir)
+        return job_dir
+
+    def checkout(self, repo_url: str, ref: str = None, job_dir: str = None,
+                 cancel_token: CancelToken = None) -> str:
+        """
+        Checks out `ref` (default branch if None) of `repo_url` into an isolated
+        worktree and returns its path.
+        Cancelling cancel_token kills the running git process and releases the job.
+        """
+        if ref is not None:
+            self._check_ref(ref)
+        job_dir = job_dir or self.reserve()
+        mirror_path = self._mirror_path(repo_url)
+
+        with self._lock:
+            job = self._jobs.get(job_dir)
+            if job is None or job["released"]:
+                raise WorkspaceError("Workspace was released before checkout started.")
+            job["busy"] = True
+            job["mirror"] = mirror_path
+            # Pin the mirror so quota enforcement can't evict it under us
+            self._active[mirror_path] = self._active.get(mirror_path, 0) + 1
+
+        try:
+            # Check out the resolved SHA, so the ref itself never reaches `worktree add`
+            commit = self._run_in_mirror(
+                repo_url, mirror_path, self._rev_parse_args(ref), ref, cancel_token
+            ).strip()
+            self._run_in_mirror(
+                repo_url, mirror_path, ["worktree", "add", "--detach", job_dir, commit],
+                cancel_token=cancel_token
+            )
+        except AnalysisCancelledError:
+            self._finish_release(job_dir)
+            raise
+        except Exception as e:
+            self._finish_release(job_dir)
+            raise WorkspaceError(f"Failed to check out repository: {str(e)}")
+
+        with self._lock:
+            job["busy"] = False
+            cancelled = job["released"]
+        if cancelled:
+            self._finish_release(job_dir)
+            raise WorkspaceError("Workspace was released during checkout.")
+
+        # Measured once here and removed on release, so the quota never rescans checkouts
+        self._write_size(job_dir, self._dir_size(job_dir))
+        with self._lock:
+            job["commit"] = commit
+        self._enforce_quota()
+        return job_dir
+
+    def resolve(self, repo_url: str, ref: str = None, cancel_token: CancelToken = None) -> str:
+        """
+        Returns the commit SHA that `ref` (default branch if None) points to, cloning or
+        refreshing the shared mirror as needed (fetches are throttled like checkouts).
+        """
+        if ref is not None:
+            self._check_ref(ref)
+        mirror_path = self._mirror_path(repo_url)
+        with self._lock:
+            self._active[mirror_path] = self._active.get(mirror_path, 0) + 1
+        try:
+            output = self._run_in_mirror(
+                repo_url, mirror_path, self._rev_parse_args(ref), ref, cancel_token
+            )
+            return output.strip()
+        except AnalysisCancelledError:
+            raise
+        except Exception as e:
+            raise WorkspaceError(f"Failed to resolve {ref or 'the default branch'} of repository: {str(e)}")
+        finally:
+            with self._lock:
+                self._active[mirror_path] = self._active.get(mirror_path, 1) - 1
+
+    def commit_of(self, job_dir: str) -> Optional[str]:
+        """
+        Returns the commit SHA checked out in job_dir, or None for directories that
+        are not checkouts (e.g. from allocate()).
+        """
+        with self._lock:
+            job = self._jobs.get(job_dir)
+            return job["commit"] if job else None
+
+    def diff(self, job_dir: str, base_ref: str, head_ref: str, cancel_token: CancelToken = None) -> str:
+        """
+        Returns `git diff base...head` (PR semantics, zero context lines) in a job's checkout.
+        Both refs are validated and resolved to SHAs first.
+        """
+        self._check_ref(base_ref)
+        self._check_ref(head_ref)
+        base = self._git(self._rev_parse_args(base_ref), job_dir, cancel_token).strip()
+        head = self._git(self._rev_parse_args(head_ref), job_dir, cancel_token).strip()
+        return self._git(
+            ["diff", "--unified=0", "--no-color", "--no-ext-diff", "--diff-filter=ACMR", "-M", f"{base}...{head}"],
+            job_dir, cancel_token
+        )
+
+    def release(self, job_dir: str):
+        """
+        Removes a job's checkout. Safe to call more than once and from another
+        thread while the checkout is still running (it is then removed as soon
+        as the checkout finishes).
+        """
+        with self._lock:
+            job = self._jobs.get(job_dir)
+            if job is not None and job["busy"]:
+                job["released"] = True
+                return
+        self._finish_release(job_dir)
+
+    # --- Internals ---
+
+    @staticmethod
+    def _check_ref(ref: str):
+        try:
+            validate_ref(ref)
+        except ValueError as e:
+            raise WorkspaceError(str(e))
+
+    @staticmethod
+    def _rev_parse_args(ref: str = None) -> list:
+        return ["rev-parse", "--verify", "--end-of-options", f"{ref or 'HEAD'}^{{commit}}"]
+
+    def _ensure_owner_dir(self) -> str:
+        with self._lock:
+            if self._owner_dir is None:
+                os.makedirs(self.mirrors_dir, exist_ok=True)
+                os.makedirs(self.jobs_dir, exist_ok=True)
+                owner_dir = os.path.join(self.jobs_dir, f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+                # Held (never unlocked) until the process exits; the OS drops it even on a crash
+                lock_file = open(f"{owner_dir}.lock", "w")
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                os.makedirs(owner_dir)
+                self._owner_lock_file = lock_file
+                self._owner_dir = owner_dir
+            return self._owner_dir
+
+    def _mirror_path(self, repo_url: str) -> str:
+        normalized = normalize_repo_url(repo_url)
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16]
+        name = "".join(c if c.isalnum() or c in "-_." else "_" for c in normalized.split("/")[-1])
+        return os.path.join(self.mirrors_dir, f"{name}-{digest}.git")
+
+    def _git(self, args: list, cwd: str, cancel_token: CancelToken = None) -> str:
+        command = ["git", *args]
+        # Never wait for credentials on a terminal nobody is watching
+        env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+        if cancel_token is not None:
+            result = cancel_token.run_process(command, cwd=cwd, env=env)
+        else:
+            result = subprocess.run(command, cwd=cwd, env=env, capture_output=True)
+        if result.returncode != 0:
+            stderr = result.stderr.decode("utf-8", errors="replace").strip()
+            raise WorkspaceError(f"git {args[0]} failed: {stderr}")
+        return result.stdout.decode("utf-8", errors="replace")
+
+    @contextmanager
+    def _mirror_lock(self, mirror_path: str, cancel_token: CancelToken = None, blocking: bool = True):
+        """
+        Serializes git operations on a mirror across threads (in-process lock) and across
+        processes sharing the root (flock on <mirror>.lock, which is never deleted).
+        Yields False instead of waiting if blocking is False and the mirror is busy.
+        """
+        with self._lock:
+            thread_lock = self._mirror_locks.setdefault(mirror_path, threading.Lock())
+        if not blocking:
+            if not thread_lock.acquire(blocking=False):
+                yield False
+                return
+        else:
+            # Another job may hold the mirror for a long clone; keep checking for cancellation
+            while not thread_lock.acquire(timeout=CancelToken.POLL_INTERVAL):
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+        try:
+            os.makedirs(self.mirrors_dir, exist_ok=True)
+            with open(f"{mirror_path}.lock", "a") as lock_file:
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if not blocking:
+                            yield False
+                            return
+                        if cancel_token is not None:
+                            cancel_token.raise_if_cancelled()
+                        time.sleep(CancelToken.POLL_INTERVAL)
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            thread_lock.release()
+
+    def _run_in_mirror(self, repo_url: str, mirror_path: str, args: list,
+                       ref: str = None, cancel_token: CancelToken = None) -> str:
+        """
+        Runs a git command in the (refreshed) mirror under its lock. Caller pins the mirror.
+        """
+        with self._mirror_lock(mirror_path, cancel_token):
+            fetched = self._ensure_mirror(repo_url, mirror_path, cancel_token)
+            try:
+                return self._git(args, mirror_path, cancel_token)
+            except WorkspaceError:
+                if fetched or not ref:
+                    raise
+                # The ref may be newer than our throttled fetch; fetch once more
+                self._fetch(mirror_path, cancel_token)
+                return self._git(args, mirror_path, cancel_token)
+
+    def _ensure_mirror(self, repo_url: str, mirror_path: str, cancel_token: CancelToken = None) -> bool:
+        """
+        Creates or refreshes the shared mirror. Caller holds the mirror lock.
+        Returns True if the mirror was cloned or fetched just now.
+        """
+        if not os.path.exists(mirror_path):
+            tmp_path = tempfile.mkdtemp(prefix=".clone-", dir=self.mirrors_dir)
+            try:
+                self._git(["clone", "--mirror", "--", repo_url, tmp_path], self.mirrors_dir, cancel_token)
+                os.replace(tmp_path, mirror_path)
+            finally:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            self._fetched_at[mirror_path] = time.monotonic()
+            self._write_size(mirror_path, self._dir_size(mirror_path))
+            return True
+
+        # Drop bookkeeping for worktrees whose directories are gone
+        self._git(["worktree", "prune"], mirror_path)
+        os.utime(mirror_path)  # LRU marker for eviction
+        last_fetch = self._fetched_at.get(mirror_path)
+        if last_fetch is not None and time.monotonic() - last_fetch < self.fetch_interval:
+            return False
+        self._fetch(mirror_path, cancel_token)
+        return True
+
+    def _fetch(self, mirror_path: str, cancel_token: CancelToken = None):
+        self._git(["fetch", "--prune", "origin"], mirror_path, cancel_token)
+        self._fetched_at[mirror_path] = time.monotonic()
+        # A bare mirror is a handful of pack files, so this walk is cheap
+        self._write_size(mirror_path, self._dir_size(mirror_path))
+
+    def _finish_release(self, job_dir: str):
+        with self._lock:
+            job = self._jobs.pop(job_dir, None)
+            mirror_path = job["mirror"] if job else None
+
+        self._remove_size(job_dir)
+        try:
+            if mirror_path and os.path.exists(mirror_path):
+                with self._mirror_lock(mirror_path):
+                    if os.path.exists(job_dir):
+                        try:
+                            self._git(["worktree", "remove", "--force", job_dir], mirror_path)
+                        except WorkspaceError:
+                            shutil.rmtree(job_dir, ignore_errors=True)
+                    self._git(["worktree", "prune"], mirror_path)
+            elif os.path.exists(job_dir) and os.path.dirname(job_dir) == self._owner_dir:
+                shutil.rmtree(job_dir, ignore_errors=True)
+        except Exception as e:
+            logger.error(f"Error cleaning up workspace {job_dir}: {e}")
+            shutil.rmtree(job_dir, ignore_errors=True)
+        finally:
+            if mirror_path:
+                with self._lock:
+                    self._active[mirror_path] = self._active.get(mirror_path, 1) - 1
+
+    def _enforce_quota(self):
+        # Dot-prefixed entries are clones still in progress
+        mirrors = [
+            os.path.join(self.mirrors_dir, name) for name in os.listdir(self.mirrors_dir)
+            if name.endswith(".git") and not name.startswith(".")
+        ]
+        sizes = {}
+        for mirror_path in mirrors:
+            size = self._read_size(mirror_path)
+            if size is None:
+                # Left by an earlier run: measured once
+                size = self._dir_size(mirror_path)
+                self._write_size(mirror_path, size)
+            sizes[mirror_path] = size
+        # Checkouts of every process sharing the root
+        job_sizes = glob.glob(os.path.join(self.jobs_dir, "*", "*.size"))
+        total = sum(sizes.values()) + sum(self._read_size(path[:-len(".size")]) or 0 for path in job_sizes)
+        if total <= self.quota_bytes:
+            return
+
+        # Least recently used first
+        mirrors.sort(key=lambda path: os.path.getmtime(path))
+        for mirror_path in mirrors:
+            if total <= self.quota_bytes:
+                break
+            with self._lock:
+                if self._active.get(mirror_path, 0) > 0:
+                    continue
+            with self._mirror_lock(mirror_path, blocking=False) as locked:
+                if not locked:
+                    continue
+                with self._lock:
+                    # A checkout may have pinned it while we waited for the lock
+                    if self._active.get(mirror_path, 0) > 0:
+                        continue
+                if self._has_worktrees(mirror_path):
+                    continue  # another process is still using it
+                shutil.rmtree(mirror_path, ignore_errors=True)
+                self._remove_size(mirror_path)
+                self._fetched_at.pop(mirror_path, None)
+                total -= sizes[mirror_path]
+                logger.info(f"Evicted workspace mirror {mirror_path} ({sizes[mirror_path]} bytes)")
+
+        if total > self.quota_bytes:
+            logger.warning(f"Workspace usage {total} bytes exceeds quota {self.quota_bytes} bytes (all in use)")
+
+    def _has_worktrees(self, mirror_path: str) -> bool:
+        # Worktrees of every process are registered in the mirror; drop those whose directory is gone
+        try:
+            self._git(["worktree", "prune"], mirror_path)
+        except WorkspaceError:
+            pass
+        worktrees_dir = os.path.join(mirror_path, "worktrees")
+        return os.path.isdir(worktrees_dir) and bool(os.listdir(worktrees_dir))
+
+    @staticmethod
+    def _write_size(path: str, size: int):
+        with open(f"{path}.size", "w") as f:
+            f.write(str(size))
+
+    @staticmethod
+    def _read_size(path: str) -> Optional[int]:
+        try:
+            with open(f"{path}.size") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _remove_size(path: str):
+        try:
+            os.remove(f"{path}.size")
+        except OSError:
+            pass
+
+    @staticmethod
+    def _dir_size(path: str) -> int:
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    continue
+        return total
+
+
+workspace_manager = WorkspaceManager(
+    root_dir=settings.workspace_root or os.path.join(tempfile.gettempdir(), "code_refine_repos"),
+    quota_bytes=settings.workspace_quota_mb * 1024 * 1024,
+    fetch_interval=settings.workspace_fetch_interval_seconds,
+)
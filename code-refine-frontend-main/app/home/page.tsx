@@ -28,7 +28,7 @@ interface LLMReport {
   security_analysis: string;
 }
 interface AnalysisResult {
-  report: string; repo_name: string;
+  report: LLMReport | string; repo_name: string;
   static_analysis?: {
     complexity: { average_score: string; average_value: number };
     security: { score: number; issues: { filename: string; issue_text: string; severity: string; line_number: number; code: string }[] };
@@ -53,6 +53,11 @@ export default function Home() {
 
   useEffect(() => {
     if (result?.report) {
+      // The backend now returns the report already parsed; older responses sent a JSON string
+      if (typeof result.report !== 'string') {
+        setParsedReport(result.report)
+        return
+      }
       try {
         const parsed = JSON.parse(result.report)
         setParsedReport(parsed)